@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import time
+from cache import DATA_DIR, Lazy, open_store
+from solver import extract_question_marks
+
+# Per-question marks parsed from evaluation reports, plus a precomputed analytics snapshot per paper.
+# Snapshots are rebuilt for the affected paper on every grade write, so reads never aggregate.
+GRADES_DB_PATH = os.path.join(DATA_DIR, "grades.sqlite3")
+SCORE_BINS = 10  # histogram buckets over 0-100%
+
+def parse_score(score):
+    """'34/80' -> (34.0, 80.0); anything unparseable -> (None, None)."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*[\/\\]\s*(\d+(?:\.\d+)?)\s*", score or "")
+    if not match or float(match.group(2)) <= 0:
+        return None, None
+    return float(match.group(1)), float(match.group(2))
+
+def _question_key(label):
+    return re.sub(r"\s+", "", label).upper().lstrip("Q").lstrip(".") or label
+
+def compute_paper_analytics(scores, marks):
+    """
+    scores: [(awarded, total)] per graded submission (None where the score is unknown).
+    marks: [(question, status, awarded, max)] rows across all submissions.
+    """
+    import numpy as np  # only needed once grades are written, keeps it out of worker start-up
+    awarded = np.array([s[0] for s in scores if s[0] is not None], dtype=float)
+    totals = np.array([s[1] for s in scores if s[0] is not None], dtype=float)
+    summary = {"submissions": len(scores), "scored": int(awarded.size)}
+    if awarded.size:
+        percent = np.clip(awarded / totals * 100, 0, 100)
+        counts, edges = np.histogram(percent, bins=SCORE_BINS, range=(0, 100))
+        summary.update({
+            "mean_score": float(awarded.mean()),
+            "mean_percent": float(percent.mean()),
+            "median_percent": float(np.median(percent)),
+            "std_percent": float(percent.std()),
+            "min_percent": float(percent.min()),
+            "max_percent": float(percent.max()),
+            "distribution": [
+                {"from": float(edges[i]), "to": float(edges[i + 1]), "count": int(counts[i])}
+                for i in range(SCORE_BINS)
+            ],
+        })
+
+    questions = []
+    if marks:
+        labels = np.array([_question_key(m[0]) for m in marks])
+        statuses = np.array([m[1] or "" for m in marks])
+        got = np.array([np.nan if m[2] is None else m[2] for m in marks], dtype=float)
+        out_of = np.array([np.nan if m[3] is None else m[3] for m in marks], dtype=float)
+        keys, first_seen, inverse = np.unique(labels, return_index=True, return_inverse=True)
+
+        counted = ~np.isnan(got)
+        attempts = np.bincount(inverse, weights=counted, minlength=keys.size)
+        total_got = np.bincount(inverse, weights=np.where(counted, got, 0), minlength=keys.size)
+        fraction = np.where(counted & (out_of > 0), got / np.where(out_of > 0, out_of, 1), np.nan)
+        has_fraction = ~np.isnan(fraction)
+        fraction_n = np.bincount(inverse, weights=has_fraction, minlength=keys.size)
+        fraction_sum = np.bincount(inverse, weights=np.where(has_fraction, fraction, 0), minlength=keys.size)
+        max_marks = np.full(keys.size, np.nan)
+        np.fmax.at(max_marks, inverse, out_of)
+        status_counts = {
+            status: np.bincount(inverse, weights=statuses == status, minlength=keys.size)
+            for status in ("correct", "partial", "incorrect")
+        }
+
+        for i in np.argsort(first_seen):
+            facility = fraction_sum[i] / fraction_n[i] if fraction_n[i] else None
+            questions.append({
+                "question": marks[first_seen[i]][0],
+                "max_marks": None if np.isnan(max_marks[i]) else float(max_marks[i]),
+                "responses": int(np.sum(inverse == i)),
+                "mean_awarded": float(total_got[i] / attempts[i]) if attempts[i] else None,
+                "facility": None if facility is None else float(facility),      # mean fraction of marks earned
+                "difficulty": None if facility is None else float(1 - facility),
+                **{status: int(counts[i]) for status, counts in status_counts.items()},
+            })
+
+    summary["questions"] = questions
+    summary["hardest"] = [
+        q["question"] for q in sorted(
+            (q for q in questions if q["difficulty"] is not None), key=lambda q: q["difficulty"], reverse=True
+        )[:5]
+    ]
+    return summary
+
+class GradeStore:
+    """SQLite store of per-question marks by submission, with per-paper analytics snapshots."""
+
+    def __init__(self, path):
+        self.lock, self.conn = open_store(path, """
+            CREATE TABLE IF NOT EXISTS graded_submissions (
+                submission_id TEXT PRIMARY KEY,
+                paper_id TEXT NOT NULL,
+                awarded REAL,
+                total REAL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS graded_submissions_paper ON graded_submissions(paper_id);
+            CREATE TABLE IF NOT EXISTS question_marks (
+                submission_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                paper_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                status TEXT,
+                awarded REAL,
+                max_marks REAL,
+                PRIMARY KEY (submission_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS question_marks_paper ON question_marks(paper_id);
+            CREATE TABLE IF NOT EXISTS paper_analytics (
+                paper_id TEXT PRIMARY KEY,
+                analytics TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+
+    def record(self, submission_id, paper_id, score, report_text):
+        """Stores (or replaces) one submission's marks and refreshes its paper's analytics."""
+        return self.record_many([(submission_id, paper_id, score, report_text)])[0]
+
+    def record_many(self, submissions):
+        """
+        Stores (or replaces) [(submission_id, paper_id, score, report_text)] in one transaction and
+        refreshes each affected paper's analytics once. Returns each submission's marks.
+        """
+        parsed = []
+        for submission_id, paper_id, score, report_text in submissions:
+            marks = extract_question_marks(report_text or "")
+            awarded, total = parse_score(score)
+            if awarded is None and marks and all(m["awarded"] is not None and m["max"] for m in marks):
+                awarded, total = sum(m["awarded"] for m in marks), sum(m["max"] for m in marks)
+            parsed.append((str(submission_id), str(paper_id), awarded, total, marks))
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            for submission_id, paper_id, awarded, total, marks in parsed:
+                self.conn.execute("DELETE FROM question_marks WHERE submission_id = ?", (submission_id,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO graded_submissions (submission_id, paper_id, awarded, total, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (submission_id, paper_id, awarded, total, time.time())
+                )
+                self.conn.executemany(
+                    "INSERT INTO question_marks (submission_id, position, paper_id, question, status, awarded, max_marks) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(submission_id, i, paper_id, m["question"], m["status"], m["awarded"], m["max"]) for i, m in enumerate(marks)]
+                )
+            for paper_id in dict.fromkeys(paper_id for _, paper_id, _, _, _ in parsed):
+                self._refresh(paper_id)
+        return [marks for _, _, _, _, marks in parsed]
+
+    def delete_submission(self, submission_id):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            row = self.conn.execute(
+                "DELETE FROM graded_submissions WHERE submission_id = ? RETURNING paper_id", (str(submission_id),)
+            ).fetchone()
+            self.conn.execute("DELETE FROM question_marks WHERE submission_id = ?", (str(submission_id),))
+            if row is not None:
+                self._refresh(row["paper_id"])
+
+    def delete_paper(self, paper_id):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            for table in ("graded_submissions", "question_marks", "paper_analytics"):
+                self.conn.execute(f"DELETE FROM {table} WHERE paper_id = ?", (str(paper_id),))
+
+    def get_analytics(self, paper_id):
+        """The precomputed snapshot, or None if no submission of this paper was graded."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT analytics, updated_at FROM paper_analytics WHERE paper_id = ?", (str(paper_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {**json.loads(row["analytics"]), "paper_id": str(paper_id), "updated_at": row["updated_at"]}
+
+    def _refresh(self, paper_id):
+        """Recomputes one paper's snapshot. Caller holds the lock inside a transaction."""
+        scores = self.conn.execute(
+            "SELECT awarded, total FROM graded_submissions WHERE paper_id = ?", (paper_id,)
+        ).fetchall()
+        if not scores:
+            self.conn.execute("DELETE FROM paper_analytics WHERE paper_id = ?", (paper_id,))
+            return
+        marks = self.conn.execute(
+            "SELECT question, status, awarded, max_marks FROM question_marks WHERE paper_id = ? ORDER BY submission_id, position",
+            (paper_id,)
+        ).fetchall()
+        analytics = compute_paper_analytics([tuple(row) for row in scores], [tuple(row) for row in marks])
+        self.conn.execute(
+            "INSERT OR REPLACE INTO paper_analytics (paper_id, analytics, updated_at) VALUES (?, ?, ?)",
+            (paper_id, json.dumps(analytics), time.time())
+        )
+
+grade_store = Lazy(lambda: GradeStore(GRADES_DB_PATH))
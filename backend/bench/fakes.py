@@ -0,0 +1,189 @@
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+import httpx
+from google.api_core import exceptions as api_exceptions
+
+# Local stand-ins for Gemini and Supabase with configurable latency and error injection.
+# Nothing here talks to the network, so benchmarks cost no quota.
+
+class Injection:
+    """Latency (mean + uniform jitter, seconds) and error rate applied to each fake request."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+# --- GEMINI ---
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, chunk_size=None, chunk_delay=0.0):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=max(1, len(text) // 4)
+        )
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+    def __iter__(self):
+        for start in range(0, len(self.text), self.chunk_size or len(self.text) or 1):
+            time.sleep(self.chunk_delay)
+            yield SimpleNamespace(text=self.text[start:start + (self.chunk_size or len(self.text))])
+
+def _prompt_tokens(content):
+    """Rough token count: ~4 characters per token, ~258 tokens per image."""
+    parts = content if isinstance(content, list) else [content]
+    return sum(258 if isinstance(part, dict) else len(str(part)) // 4 for part in parts)
+
+def _solution_text(page_number):
+    return "".join(
+        f"**Q{(page_number - 1) * 3 + i} (2 Marks):** * Step 1: Apply the formula.\n"
+        f"* Final Answer: $$ \\boxed{{{page_number * 10 + i}}} $$\n\n"
+        for i in range(1, 4)
+    )
+
+def _report_text():
+    rows = "".join(
+        f"| Q{i} | {status} | {awarded} | 2 | Feedback for Q{i}. |\n"
+        for i, (status, awarded) in enumerate([("Correct", 2), ("Partial", 1), ("Incorrect", 0)] * 2, start=1)
+    )
+    return (
+        "## Student Evaluation Report\n"
+        "| Question | Status | Marks Awarded | Max Marks | Feedback |\n"
+        "| :--- | :--- | :--- | :--- | :--- |\n" + rows + "\n**Total Score:** 6 / 12"
+    )
+
+def _paper_text():
+    return "<center><h1>Benchmark Paper</h1></center>\n\n" + "".join(
+        f"**{i}.** Find the value of $x$ if $2x + {i} = {i * 3}$. (1 Mark)\n\n\n" for i in range(1, 39)
+    )
+
+def make_fake_model(injection, stream_chunk=200, stream_chunk_delay=0.0):
+    """Builds a drop-in class for genai.GenerativeModel bound to `injection`."""
+
+    class FakeGenerativeModel:
+        def __init__(self, model_name=None, system_instruction=None, generation_config=None, safety_settings=None):
+            self.model_name = model_name
+            self.system_instruction = system_instruction or ""
+
+        def generate_content(self, content, stream=False, **kwargs):
+            time.sleep(injection.delay())
+            if injection.should_fail():
+                raise api_exceptions.ServiceUnavailable("Injected fake overload")
+
+            first = content[0] if isinstance(content, list) else content
+            if "grader" in self.system_instruction:
+                text = _report_text()
+            elif "Paper Setter" in self.system_instruction:
+                text = _paper_text()
+            else:
+                packed = [int(n) for part in content[1:] for n in re.findall(r"^Page (\d+):$", str(part))]
+                if "<<<PAGE" in str(first) and packed:
+                    # Packed request: one marked section per page
+                    text = "".join(f"<<<PAGE {n}>>>\n{_solution_text(n)}" for n in packed)
+                else:
+                    page = re.search(r"Page (\d+)", str(first))
+                    text = _solution_text(int(page.group(1)) if page else 1)
+            if stream:
+                return FakeResponse(text, _prompt_tokens(content), stream_chunk, stream_chunk_delay)
+            return FakeResponse(text, _prompt_tokens(content))
+
+    return FakeGenerativeModel
+
+# --- SUPABASE ---
+class FakeSupabase:
+    """
+    In-memory PostgREST + Storage, served through httpx.MockTransport.
+    Supports the subset db.py uses: eq/in filters, created_at ordering, limit, return=representation.
+    """
+
+    def __init__(self, injection):
+        self.injection = injection
+        self.tables = {"solutions": [], "generated_papers": [], "student_submissions": []}
+        self.storage = {}
+        self.requests = 0
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.injection.delay())
+        if self.injection.should_fail():
+            return httpx.Response(503, json={"message": "Injected fake outage"})
+
+        path = request.url.path
+        if path.startswith("/rest/v1/"):
+            return self._rest(request, path.rsplit("/", 1)[-1])
+        if path.startswith("/storage/v1/object"):
+            return self._storage(request, path)
+        return httpx.Response(404)
+
+    def _matches(self, row, params):
+        for column, condition in params.items():
+            if column in ("select", "order", "limit", "or", "on_conflict"):
+                continue
+            op, _, value = condition.partition(".")
+            if op == "eq" and str(row.get(column)) != value:
+                return False
+            if op == "in" and str(row.get(column)) not in value.strip("()").split(","):
+                return False
+        return True
+
+    def _rest(self, request, table):
+        rows = self.tables.setdefault(table, [])
+        params = dict(request.url.params)
+        if request.method == "GET":
+            found = [row for row in rows if self._matches(row, params)]
+            if "order" in params:
+                found.sort(key=lambda row: (row.get("created_at") or "", str(row.get("id"))), reverse=True)
+            if "limit" in params:
+                found = found[:int(params["limit"])]
+            return httpx.Response(200, json=found)
+        if request.method == "POST":
+            body = json.loads(request.content)
+            body = body if isinstance(body, list) else [body]
+            for row in body:
+                row.setdefault("id", str(uuid.uuid4()))
+                rows.append(row)
+            return httpx.Response(201, json=body)
+        if request.method == "PATCH":
+            changes = json.loads(request.content)
+            updated = [row for row in rows if self._matches(row, params)]
+            for row in updated:
+                row.update(changes)
+            return httpx.Response(200, json=updated)
+        if request.method == "DELETE":
+            deleted = [row for row in rows if self._matches(row, params)]
+            self.tables[table] = [row for row in rows if not self._matches(row, params)]
+            return httpx.Response(200, json=deleted)
+        return httpx.Response(405)
+
+    def _storage(self, request, path):
+        if request.method == "POST":
+            self.storage[path.split("/object/", 1)[1]] = request.content
+            return httpx.Response(200, json={})
+        if request.method == "DELETE":
+            bucket = path.split("/object/", 1)[1]
+            for prefix in json.loads(request.content)["prefixes"]:
+                self.storage.pop(f"{bucket}/{prefix}", None)
+            return httpx.Response(200, json=[])
+        if request.method == "GET":
+            stored = self.storage.get(path.split("/object/public/", 1)[-1])
+            return httpx.Response(200, content=stored) if stored is not None else httpx.Response(404)
+        return httpx.Response(405)
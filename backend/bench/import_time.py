@@ -0,0 +1,71 @@
+"""
+Import-time budget for worker start-up.
+
+Imports `main` in a fresh interpreter with `-X importtime`, prints the slowest modules and
+exits non-zero when the total exceeds the budget or a module that must stay lazy was imported.
+
+    cd backend
+    python -m bench.import_time --budget-ms 800
+"""
+import os
+import re
+import sys
+import argparse
+import tempfile
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported on first use (model call, PDF render, grade write), never at start-up
+LAZY_MODULES = ("google.generativeai", "pypdfium2", "numpy")
+
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+def measure(module="main"):
+    """Returns [(module, self_us, cumulative_us, depth)] in import order."""
+    with tempfile.TemporaryDirectory(prefix="ta-import-") as workdir:
+        env = {**os.environ, "DATA_DIR": os.path.join(workdir, "data"), "CACHE_DIR": os.path.join(workdir, "cache")}
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of the app against a budget")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "800")))
+    parser.add_argument("--runs", type=int, default=3, help="best of N runs (first runs pay for cold disk caches)")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    runs = [measure(args.module) for _ in range(max(1, args.runs))]
+    rows = min(runs, key=lambda rows: next(cum for name, _, cum, _ in rows if name == args.module))
+    total_ms = next(cum for name, _, cum, _ in rows if name == args.module) / 1000
+
+    print(f"import {args.module}: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms, best of {len(runs)})")
+    print("slowest top-level imports:")
+    top_level = sorted((row for row in rows if row[3] <= 1 and row[0] != args.module), key=lambda row: -row[2])
+    for name, _, cumulative, _ in top_level[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    imported = {name for name, _, _, _ in rows}
+    eager = [name for name in LAZY_MODULES if name in imported]
+    failed = False
+    if eager:
+        print(f"FAIL: imported at start-up but should be lazy: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: over budget by {total_ms - args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Offline benchmark for /solve, /evaluate and /generate-paper.
+
+Runs the FastAPI app in-process against fake Gemini and Supabase backends (bench/fakes.py)
+and reports throughput, latency percentiles and peak RSS per scenario and concurrency.
+
+    cd backend
+    python -m bench.run --scenarios solve,evaluate,generate --concurrency 1,4,8 --requests 16 \
+        --model-latency 0.8 --model-jitter 0.3 --model-error-rate 0.05 --db-latency 0.03
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "Samples")
+
+SCENARIOS = ("solve", "evaluate", "generate")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4", help="comma-separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=8, help="requests per scenario and concurrency level")
+    parser.add_argument("--solve-file", default="PW Question Paper.pdf", help="file in Samples/ posted to /solve")
+    parser.add_argument("--student-file", default="PW Answer.pdf", help="file in Samples/ posted to /evaluate")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="seconds per fake Gemini request")
+    parser.add_argument("--model-jitter", type=float, default=0.1)
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="fraction of Gemini requests failing with 503")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="seconds per fake Supabase request")
+    parser.add_argument("--db-jitter", type=float, default=0.01)
+    parser.add_argument("--db-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rpm", type=int, default=None, help="override MODEL_RPM (the app default throttles to 60/min)")
+    parser.add_argument("--cache", action="store_true", help="keep the solution cache on (repeated pages become hits)")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+def configure_environment(args, workdir):
+    """Must run before the app modules are imported: they read their settings at import time."""
+    os.environ.setdefault("SUPABASE_URL", "http://supabase.bench")
+    os.environ.setdefault("SUPABASE_KEY", "bench")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+    if not args.cache:
+        os.environ["SOLUTION_CACHE_MAX_BYTES"] = "0"
+    if args.rpm:
+        os.environ["MODEL_RPM"] = str(args.rpm)
+    sys.path.insert(0, BACKEND_DIR)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def _high_water_kib(pid):
+    """VmHWM (peak RSS) of a live process on Linux, or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def peak_rss_mb():
+    """Peak resident set size of this process and the sum over the render pool workers, in MiB."""
+    import imaging
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB on Linux
+    # Live pool workers are not in RUSAGE_CHILDREN until they exit, so read them from /proc where possible
+    pool = imaging._render_pool
+    workers = [_high_water_kib(pid) for pid in (getattr(pool, "_processes", None) or {})]
+    if workers and None not in workers:
+        children = sum(workers) * 1024 / scale
+    else:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / scale, 1), round(children / scale, 1)
+
+def read_sample(filename):
+    with open(os.path.join(SAMPLES_DIR, filename), "rb") as f:
+        return f.read()
+
+def content_type(filename):
+    return "application/pdf" if filename.lower().endswith(".pdf") else "image/png" if filename.lower().endswith(".png") else "image/jpeg"
+
+# --- SCENARIOS: each returns None on success or an error string ---
+def make_scenarios(args):
+    solve_bytes = read_sample(args.solve_file)
+    student_bytes = read_sample(args.student_file)
+
+    async def solve(client, n):
+        response = await client.post(
+            "/solve",
+            files=[("files", (args.solve_file, solve_bytes, content_type(args.solve_file)))],
+            data={"name": f"bench-{n}"},
+        )
+        if response.status_code != 200:
+            return f"HTTP {response.status_code}"
+        last = json.loads(response.text.strip().splitlines()[-1])
+        if last.get("status") != "completed":
+            return last.get("error") or last.get("status")
+        return f"{len(last['failed_pages'])} failed page(s)" if last.get("failed_pages") else None
+
+    async def evaluate(client, n):
+        response = await client.post(
+            "/evaluate",
+            files={"student_file": (args.student_file, student_bytes, content_type(args.student_file))},
+            data={"paper_id": "bench-paper", "student_name": f"student-{n}", "reference_solution": "**Q1 (2 Marks):** x = 2"},
+        )
+        return None if response.status_code == 200 else f"HTTP {response.status_code}"
+
+    async def generate(client, n):
+        response = await client.post("/generate-paper", json={
+            "name": f"bench-{n}", "class_level": "10", "subject": "Mathematics", "board": "CBSE",
+            "paper_type": "Full", "chapters": ["Algebra"], "difficulty": 50,
+        })
+        return None if response.status_code == 200 else f"HTTP {response.status_code}"
+
+    return {"solve": solve, "evaluate": evaluate, "generate": generate}
+
+async def run_level(client, scenario, concurrency, total):
+    """Fires `total` requests with `concurrency` in flight. Returns the result row."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], {}
+
+    async def one(n):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                error = await scenario(client, n)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            latencies.append(time.perf_counter() - started)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(total)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    own_rss, children_rss = peak_rss_mb()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(total / wall, 3) if wall else None,
+        "p50": round(percentile(latencies, 50), 3),
+        "p95": round(percentile(latencies, 95), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "errors": errors,
+        "peak_rss_mb": own_rss,
+        "peak_child_rss_mb": children_rss,
+    }
+
+async def run(args):
+    import httpx
+    import google.generativeai as genai
+    from bench.fakes import Injection, FakeSupabase, make_fake_model
+
+    genai.GenerativeModel = make_fake_model(Injection(args.model_latency, args.model_jitter, args.model_error_rate, args.seed))
+    supabase = FakeSupabase(Injection(args.db_latency, args.db_jitter, args.db_error_rate, args.seed))
+
+    import db
+    import main
+    transport = supabase.transport()
+
+    async def init_fake_db():
+        await db.init_db(transport=transport)
+    main.init_db = init_fake_db
+
+    scenarios = make_scenarios(args)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    results = []
+    async with main.lifespan(main.app):
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False), base_url="http://bench", timeout=None)
+        async with client:
+            for name in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+                if name not in scenarios:
+                    raise SystemExit(f"Unknown scenario: {name} (choose from {', '.join(SCENARIOS)})")
+                # One warm-up request so pool start-up is not billed to the first level
+                await scenarios[name](client, -1)
+                for level in levels:
+                    row = {"scenario": name, **await run_level(client, scenarios[name], level, args.requests)}
+                    results.append(row)
+                    print_row(row)
+    return results
+
+def print_row(row):
+    errors = ", ".join(f"{count}x {error}" for error, count in row["errors"].items()) or "-"
+    print(
+        f"{row['scenario']:<9} c={row['concurrency']:<3} n={row['requests']:<4} "
+        f"{row['throughput_rps']:>7.2f} req/s  p50 {row['p50']:>7.3f}s  p95 {row['p95']:>7.3f}s  p99 {row['p99']:>7.3f}s  "
+        f"rss {row['peak_rss_mb']:>7.1f} MiB (+{row['peak_child_rss_mb']:.1f} children)  errors: {errors}",
+        flush=True
+    )
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="ta-bench-") as workdir:
+        configure_environment(args, workdir)
+        results = asyncio.run(run(args))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
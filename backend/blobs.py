@@ -0,0 +1,92 @@
+import os
+import time
+from cache import DATA_DIR, Lazy, open_store
+
+# Index of content-addressed Storage objects (objects/<sha256>.<ext>) with a reference count per
+# object, so identical uploads are stored once and only removed with the last row that uses them.
+BLOBS_DB_PATH = os.path.join(DATA_DIR, "blobs.sqlite3")
+
+def blob_path(digest, filename):
+    """Storage path of the object with this SHA-256; the extension is kept for downloads."""
+    return f"objects/{digest[:2]}/{digest}{os.path.splitext(filename or '')[1].lower()}"
+
+class BlobIndex:
+    """SQLite index of stored objects by (bucket, path) with reference counts."""
+
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self.lock, self.conn = open_store(path, """
+            CREATE TABLE IF NOT EXISTS blobs (
+                bucket TEXT NOT NULL,
+                path TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (bucket, path)
+            );
+        """)
+
+    def acquire(self, bucket, path):
+        """Takes a reference on an object if it is already stored. Returns False when it has to be uploaded."""
+        with self.lock:
+            row = self.conn.execute(
+                "UPDATE blobs SET refs = refs + 1 WHERE bucket = ? AND path = ? RETURNING refs", (bucket, path)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, bucket, path, digest, size):
+        """Records a freshly uploaded object with one reference (or one more, if a concurrent upload won)."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO blobs (bucket, path, sha256, size, refs, created_at) VALUES (?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (bucket, path) DO UPDATE SET refs = refs + 1",
+                (bucket, path, digest, size, time.time())
+            )
+
+    def release(self, bucket, path):
+        """
+        Drops one reference. Returns True when the object should be removed from Storage:
+        the last reference is gone, or the path was never indexed (per-job files).
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            row = self.conn.execute(
+                "UPDATE blobs SET refs = refs - 1 WHERE bucket = ? AND path = ? RETURNING refs", (bucket, path)
+            ).fetchone()
+            if row is None:
+                return True
+            if row["refs"] > 0:
+                return False
+            self.conn.execute("DELETE FROM blobs WHERE bucket = ? AND path = ?", (bucket, path))
+            return True
+
+    def referenced(self, bucket, path):
+        """Whether any row still holds a reference on the object."""
+        with self.lock:
+            row = self.conn.execute("SELECT refs FROM blobs WHERE bucket = ? AND path = ?", (bucket, path)).fetchone()
+        return row is not None and row["refs"] > 0
+
+    def stats(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT COUNT(*) AS objects, COALESCE(SUM(size), 0) AS bytes, "
+                "COALESCE(SUM(refs), 0) AS refs, COALESCE(SUM(size * (refs - 1)), 0) AS saved FROM blobs"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "objects": row["objects"],
+            "bytes": row["bytes"],
+            "references": row["refs"],
+            "deduplicated_bytes": row["saved"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+blob_index = Lazy(lambda: BlobIndex(BLOBS_DB_PATH))
@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data"))
+SOLUTION_CACHE_MAX_BYTES = int(os.getenv("SOLUTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+def open_store(path, schema):
+    """
+    Opens a local SQLite store (autocommit, WAL, rows as sqlite3.Row) and creates its schema.
+    Returns (lock, conn); the connection is shared across threads, so hold the lock around every use.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(schema)
+    return threading.Lock(), conn
+
+class SQLiteLRUCache:
+    """
+    Persistent key -> bytes cache on a local SQLite file.
+    Evicts least recently used entries once the stored values exceed `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes: return
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old: self.total_bytes -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.total_bytes += len(value)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            row = self.conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 1").fetchone()
+            if row is None: break
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+            self.total_bytes -= row[1]
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after `ttl` seconds.
+    Keys are (namespace, ...) tuples so writers can drop a whole namespace at once;
+    a per-namespace generation stops a read that raced a write from caching stale rows.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.namespaces = {}          # namespace -> set of keys
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def generation(self, namespace):
+        with self.lock:
+            return self.generations.get(namespace, 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        """Stores `value` unless its namespace was invalidated since `generation` was read."""
+        namespace = key[0]
+        with self.lock:
+            if generation is not None and generation != self.generations.get(namespace, 0):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            self.namespaces.setdefault(namespace, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+    def pop(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def invalidate(self, namespace):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+            for key in self.namespaces.pop(namespace, ()):
+                self.entries.pop(key, None)
+            self.invalidations += 1
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        keys = self.namespaces.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.namespaces[key[0]]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class Lazy:
+    """
+    Stands in for an object that is only built on first attribute access, so importing
+    a module never creates directories or opens SQLite files.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+                target = self._target
+        return getattr(target, name)
+
+# Solved page markdown, keyed by page image hash + model + prompt (see solver.page_cache_key)
+solution_cache = Lazy(lambda: SQLiteLRUCache(os.path.join(CACHE_DIR, "solutions.sqlite3"), SOLUTION_CACHE_MAX_BYTES))
+
+# Rendered PDFs, keyed by markdown hash + template version (see pdfs.pdf_cache_key)
+pdf_cache = Lazy(lambda: SQLiteLRUCache(os.path.join(CACHE_DIR, "pdfs.sqlite3"), PDF_CACHE_MAX_BYTES))
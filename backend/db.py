@@ -1,153 +1,648 @@
 import os
-from supabase import create_client, Client
-from dotenv import load_dotenv
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import base64
+import httpx
 from datetime import datetime
-
-load_dotenv()
+from dotenv import load_dotenv
+from cache import TTLCache
+from blobs import blob_index, blob_path
+from metrics import span
 
 url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
 
-def upload_bytes_to_supabase(file_bytes, bucket_name, destination_path, content_type):
+# One pooled client per worker, talking to Supabase's REST (PostgREST) and Storage APIs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "30"))
+
+_client: httpx.AsyncClient = None
+
+def _load_credentials():
+    """Fills url/key from .env when the process environment lacks them (scripts that never import main.py)."""
+    global url, key
+    if not url or not key:
+        load_dotenv()
+        url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+
+async def init_db(transport=None):
+    """
+    Creates the pooled HTTP client. Called once from the app lifespan.
+    `transport` replaces the network (the benchmark suite passes a local Supabase stand-in).
+    Without credentials the worker still starts; database calls then fail with a clear error.
+    """
+    _load_credentials()
+    if not url or not key:
+        print("SUPABASE_URL / SUPABASE_KEY are not set; database calls will fail")
+        return
+    _connect(transport)
+
+def _connect(transport=None):
+    global _client
+    _client = httpx.AsyncClient(
+        base_url=url,
+        headers={"apikey": key, "Authorization": f"Bearer {key}"},
+        limits=httpx.Limits(max_connections=DB_POOL_SIZE, max_keepalive_connections=DB_POOL_SIZE),
+        timeout=DB_TIMEOUT,
+        transport=transport,
+    )
+
+async def close_db():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _http():
+    if _client is None:
+        _load_credentials()
+        if not url or not key:
+            raise RuntimeError("SUPABASE_URL and SUPABASE_KEY must be set")
+        # Not started through the lifespan (scripts, one-off jobs): connect on first use
+        _connect()
+    return _client
+
+async def _table(method, table, params=None, json=None, returning=False):
+    """Runs one PostgREST request and returns the decoded rows."""
+    headers = {"Prefer": "return=representation"} if returning else {}
+    with span(f"db.{table}.{method.lower()}"):
+        response = await _http().request(method, f"/rest/v1/{table}", params=params, json=json, headers=headers)
+    response.raise_for_status()
+    return response.json() if response.content else []
+
+# --- LIST QUERIES (keyset pagination + projection) ---
+# Without a `limit` a list read returns every row, as it did before pagination
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+
+LIST_COLUMNS = {
+    "solutions": ("id", "name", "original_url", "solution_url", "created_at"),
+    "generated_papers": ("id", "name", "class_level", "subject", "board", "file_url", "created_at"),
+    "student_submissions": ("id", "paper_id", "student_name", "score", "submission_url", "report_url", "created_at"),
+}
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row["created_at"], row["id"]]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), str(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _select_columns(table, columns):
+    """Validates a requested column list; the keyset columns are always included."""
+    if not columns:
+        return "*"
+    unknown = set(columns) - set(LIST_COLUMNS[table])
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    return ",".join(dict.fromkeys([*columns, "id", "created_at"]))
+
+async def _list_page(table, filters=None, limit=None, cursor=None, columns=None):
+    """
+    Newest-first page of rows. Returns (rows, next_cursor); next_cursor is None on the last page.
+    With no `limit` every row after `cursor` comes back in one page.
+    """
+    params = {
+        "select": _select_columns(table, columns),
+        "order": "created_at.desc,id.desc",
+        **(filters or {})
+    }
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        params["limit"] = str(limit + 1)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        params["or"] = f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}"))'
+    rows = await _table("GET", table, params=params)
+    if limit is None:
+        return rows, None
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+# --- READ-THROUGH CACHE ---
+# List reads are served from memory until a write in this module touches the same
+# namespace. The TTL bounds staleness from writes made by other workers.
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "1024"))
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "30"))
+
+read_cache = TTLCache(READ_CACHE_SIZE, READ_CACHE_TTL)
+
+class ListPage:
+    """
+    A cached list page. The JSON body and its ETag are rendered once and reused
+    until the set of tombstoned rows in the table changes.
+    """
+
+    def __init__(self, table, rows, next_cursor):
+        self.table = table
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.rendered = None  # (hidden tombstones, body, etag)
+
+    def render(self):
+        hidden = frozenset(t for t in _tombstones if t[0] == self.table)
+        if self.rendered is None or self.rendered[0] != hidden:
+            body = json.dumps(_hide_tombstoned(self.table, self.rows)).encode("utf-8")
+            self.rendered = (hidden, body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+        return self.rendered[1], self.rendered[2]
+
+def _submissions_namespace(paper_id):
+    return f"student_submissions:{paper_id}"
+
+async def _cached_list_page(namespace, table, filters=None, limit=None, cursor=None, columns=None):
+    key = (namespace, limit, cursor, tuple(columns) if columns else None)
+    cached = read_cache.get(key)
+    if cached is None:
+        generation = read_cache.generation(namespace)
+        rows, next_cursor = await _list_page(table, filters, limit=limit, cursor=cursor, columns=columns)
+        cached = ListPage(table, rows, next_cursor)
+        read_cache.set(key, cached, generation)
+    return cached
+
+STORAGE_CHUNK_BYTES = 256 * 1024
+
+async def _storage_upload(bucket_name, path, content, content_type, size=None):
+    headers = {"content-type": content_type, "x-upsert": "true"}
+    if size is not None:
+        # Streamed bodies are otherwise sent chunked; Storage wants the length up front
+        headers["content-length"] = str(size)
+    with span("storage.upload"):
+        response = await _http().post(f"/storage/v1/object/{bucket_name}/{path}", content=content, headers=headers)
+    response.raise_for_status()
+
+async def _file_chunks(path):
+    """Yields a file in chunks sliced from a read-only memory map, so it is never copied whole."""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for start in range(0, len(buffer), STORAGE_CHUNK_BYTES):
+                yield buffer[start:start + STORAGE_CHUNK_BYTES]
+
+async def _storage_remove(bucket_name, paths):
+    with span("storage.remove"):
+        response = await _http().request("DELETE", f"/storage/v1/object/{bucket_name}", json={"prefixes": paths})
+    response.raise_for_status()
+
+def public_url(bucket_name, path):
+    return f"{url}/storage/v1/object/public/{bucket_name}/{path}"
+
+async def upload_bytes_to_supabase(file_bytes, bucket_name, destination_path, content_type):
     """Uploads in-memory bytes"""
-    supabase.storage.from_(bucket_name).upload(
-        file=file_bytes,
-        path=destination_path,
-        file_options={"content-type": content_type, "upsert": "true"}
+    await _storage_upload(bucket_name, destination_path, file_bytes, content_type)
+    return public_url(bucket_name, destination_path)
+
+# --- CONTENT-ADDRESSED STORAGE (originals, student scripts, generated papers) ---
+# Immutable files are stored once under their SHA-256 and shared by every row that uploads the same bytes.
+# Files edited in place (solutions, evaluation reports) keep their per-job paths.
+_pending_blobs = {}  # (bucket, path) -> upload task, so concurrent identical uploads send the bytes once
+_removing_blobs = {}  # (bucket, path) -> remove task; uploads of the same bytes wait for it, then store a fresh copy
+
+async def _store_blob(bucket_name, path, digest, size, upload):
+    """Takes a reference on the object at `path`, running `upload()` first unless it is already stored."""
+    key = (bucket_name, path)
+    while key in _removing_blobs:
+        await asyncio.shield(_removing_blobs[key])
+    if not blob_index.acquire(bucket_name, path):
+        task = _pending_blobs.get(key)
+        if task is None:
+            task = asyncio.ensure_future(upload())
+            _pending_blobs[key] = task
+            task.add_done_callback(lambda _: _pending_blobs.pop(key, None))
+        await asyncio.shield(task)
+        blob_index.add(bucket_name, path, digest, size)
+    return public_url(bucket_name, path)
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+async def upload_bytes_deduplicated(file_bytes, bucket_name, filename, content_type):
+    """Uploads in-memory bytes unless the same content is already stored"""
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    path = blob_path(digest, filename)
+    return await _store_blob(
+        bucket_name, path, digest, len(file_bytes),
+        lambda: _storage_upload(bucket_name, path, file_bytes, content_type)
+    )
+
+async def upload_file_deduplicated(file_path, bucket_name, filename, content_type):
+    """Uploads a file on disk unless the same content is already stored"""
+    digest = await asyncio.to_thread(_file_digest, file_path)
+    path = blob_path(digest, filename)
+    size = os.path.getsize(file_path)
+    return await _store_blob(
+        bucket_name, path, digest, size,
+        lambda: _storage_upload(bucket_name, path, _file_chunks(file_path), content_type, size)
     )
-    project_url = os.getenv("SUPABASE_URL")
-    return f"{project_url}/storage/v1/object/public/{bucket_name}/{destination_path}"
 
 # --- SOLVED PAPERS (HISTORY) ---
-def save_record(name, original_url, solution_url):
-    response = supabase.table('solutions').insert({
+async def save_record(name, original_url, solution_url):
+    rows = await _table("POST", "solutions", json={
         "name": name,
         "original_url": original_url,
         "solution_url": solution_url,
         "created_at": datetime.now().isoformat()
-    }).execute()
-    if response.data and len(response.data) > 0:
-        return response.data[0]['id']
+    }, returning=True)
+    read_cache.invalidate("solutions")
+    if rows:
+        storage_paths.set(("solutions", str(rows[0]['id'])), _edit_path(solution_url, "solutions/"))
+        return rows[0]['id']
     return None
 
-def update_paper_solution(paper_id, new_solution_text):
-    data = supabase.table('solutions').select("solution_url").eq('id', paper_id).execute()
-    if not data.data: return False
-    
-    url = data.data[0]['solution_url']
-    if url and "solutions/" in url:
-        path = "solutions/" + url.split("solutions/")[-1]
-        supabase.storage.from_("papers").upload(
-            file=new_solution_text.encode('utf-8'),
-            path=path,
-            file_options={"content-type": "text/markdown", "upsert": "true"}
-        )
-        return True
-    return False
+async def _solution_path(paper_id):
+    """Storage path of a paper's solution file, looked up once per paper. "" if it has none, None if there is no such paper."""
+    key = ("solutions", str(paper_id))
+    path = storage_paths.get(key)
+    if path is None:
+        rows = await _table("GET", "solutions", params={"select": "solution_url", "id": f"eq.{paper_id}"})
+        if not rows:
+            return None
+        path = _edit_path(rows[0]['solution_url'], "solutions/")
+        storage_paths.set(key, path)
+    return path
+
+async def update_paper_solution(paper_id, new_solution_text, on_saved=None):
+    """
+    Queues the new solution text for a write-behind upload. Returns its version, or None if the paper does not exist.
+    A paper without a solution file (its upload failed) gets one on the first write.
+    `on_saved(text)` is awaited after each successful write.
+    """
+    key = ("solutions", str(paper_id))
+    path = await _solution_path(paper_id)
+    if path is None:
+        return None
+    created = not path
+    if created:
+        path = f"solutions/{paper_id}.md"
+
+    async def write(text):
+        await _storage_upload("papers", path, text.encode('utf-8'), "text/markdown")
+        if created and not storage_paths.get(key):
+            await _table("PATCH", "solutions", params={"id": f"eq.{paper_id}"}, json={
+                "solution_url": public_url("papers", path)
+            })
+            read_cache.invalidate("solutions")
+            storage_paths.set(key, path)
+    return _schedule_edit(key, new_solution_text, write, on_saved)
+
+async def get_paper_solution_text(paper_id):
+    """Downloads a paper's stored solution markdown. Returns None if the paper or its file is missing."""
+    pending = _pending_edit(("solutions", str(paper_id)))
+    if pending is not None:
+        return pending
+    path = await _solution_path(paper_id)
+    return await _download_text(path) if path else None
 
-def get_records():
-    response = supabase.table('solutions').select("*").order("created_at", desc=True).execute()
-    return response.data
+async def get_records(limit=None, cursor=None, columns=None):
+    return await _cached_list_page("solutions", "solutions", limit=limit, cursor=cursor, columns=columns)
 
 # --- GENERATED PAPERS (UPDATED) ---
-def save_generated_paper(name, class_level, subject, board, file_url):
+async def save_generated_paper(name, class_level, subject, board, file_url):
     """Saves a record to the generated_papers table including the board"""
-    response = supabase.table('generated_papers').insert({
+    rows = await _table("POST", "generated_papers", json={
         "name": name,
         "class_level": class_level,
         "subject": subject,
         "board": board,
         "file_url": file_url,
         "created_at": datetime.now().isoformat()
-    }).execute()
-    if response.data and len(response.data) > 0:
-        return response.data[0]['id']
+    }, returning=True)
+    read_cache.invalidate("generated_papers")
+    if rows:
+        storage_paths.set(("generated_papers", str(rows[0]['id'])), _storage_path(file_url) or "")
+        return rows[0]['id']
     return None
 
-def get_generated_papers():
-    response = supabase.table('generated_papers').select("*").order("created_at", desc=True).execute()
-    return response.data
+async def get_generated_paper_text(paper_id):
+    """Downloads a generated paper's markdown. Returns None if the paper or its file is missing."""
+    key = ("generated_papers", str(paper_id))
+    path = storage_paths.get(key)
+    if path is None:
+        rows = await _table("GET", "generated_papers", params={"select": "file_url", "id": f"eq.{paper_id}"})
+        if not rows:
+            return None
+        path = _storage_path(rows[0]['file_url']) or ""
+        storage_paths.set(key, path)
+    return await _download_text(path) if path else None
 
-def delete_generated_paper(paper_id):
-    # 1. Get file URL to delete from storage
-    data = supabase.table('generated_papers').select("file_url").eq('id', paper_id).execute()
-    if data.data:
-        delete_from_storage(data.data[0]['file_url'])
-    
-    # 2. Delete record
-    supabase.table('generated_papers').delete().eq('id', paper_id).execute()
+async def get_generated_papers(limit=None, cursor=None, columns=None):
+    return await _cached_list_page("generated_papers", "generated_papers", limit=limit, cursor=cursor, columns=columns)
+
+async def delete_generated_paper(paper_id):
+    # Delete the record and get its file URL back in one request
+    rows = await _table(
+        "DELETE", "generated_papers", params={"id": f"eq.{paper_id}", "select": "file_url"}, returning=True
+    )
+    read_cache.invalidate("generated_papers")
+    storage_paths.pop(("generated_papers", str(paper_id)))
+    await delete_from_storage(*(row['file_url'] for row in rows))
 
 # --- STUDENT SUBMISSIONS ---
-def save_student_submission(paper_id, student_name, score, submission_url, report_url):
-    response = supabase.table('student_submissions').insert({
+async def save_student_submission(paper_id, student_name, score, submission_url, report_url):
+    return await save_student_submissions([{
         "paper_id": paper_id,
         "student_name": student_name,
         "score": score,
         "submission_url": submission_url,
-        "report_url": report_url,
-        "created_at": datetime.now().isoformat()
-    }).execute()
-    return response.data
-
-def update_student_submission(student_id, new_score, new_report_text):
-    supabase.table('student_submissions').update({"score": new_score}).eq('id', student_id).execute()
-    
-    data = supabase.table('student_submissions').select("report_url").eq('id', student_id).execute()
-    if data.data and data.data[0]['report_url']:
-        url = data.data[0]['report_url']
-        if "evaluations/" in url:
-            path = "evaluations/" + url.split("evaluations/")[-1]
-            supabase.storage.from_("papers").upload(
-                file=new_report_text.encode('utf-8'),
-                path=path,
-                file_options={"content-type": "text/markdown", "upsert": "true"}
-            )
-    return True
-
-def get_student_submissions(paper_id):
-    response = supabase.table('student_submissions')\
-        .select("*")\
-        .eq('paper_id', paper_id)\
-        .order('created_at', desc=True)\
-        .execute()
-    return response.data
+        "report_url": report_url
+    }])
+
+async def save_student_submissions(rows):
+    """Inserts many submissions in a single request."""
+    created_at = datetime.now().isoformat()
+    saved = await _table("POST", "student_submissions", json=[
+        {**row, "created_at": created_at} for row in rows
+    ], returning=True)
+    for paper_id in {row["paper_id"] for row in rows}:
+        read_cache.invalidate(_submissions_namespace(paper_id))
+    for row in saved:
+        storage_paths.set(
+            ("student_submissions", str(row["id"])), (row["paper_id"], _edit_path(row.get("report_url"), "evaluations/"))
+        )
+    return saved
+
+async def _submission_paths(student_id):
+    """(paper_id, report path) of a submission, looked up once per submission. None if it does not exist."""
+    key = ("student_submissions", str(student_id))
+    found = storage_paths.get(key)
+    if found is None:
+        rows = await _table(
+            "GET", "student_submissions", params={"select": "paper_id,report_url", "id": f"eq.{student_id}"}
+        )
+        if not rows:
+            return None
+        found = (rows[0]["paper_id"], _edit_path(rows[0]["report_url"], "evaluations/"))
+        storage_paths.set(key, found)
+    return found
+
+async def update_student_submission(student_id, new_score, new_report_text):
+    """
+    Queues the new score and report for a write-behind save.
+    Returns (version, paper_id), or None if the submission does not exist.
+    """
+    found = await _submission_paths(student_id)
+    if found is None:
+        return None
+    paper_id, report_path = found
+
+    async def write(edit):
+        score, report_text = edit
+        writes = [_table("PATCH", "student_submissions", params={"id": f"eq.{student_id}"}, json={"score": score})]
+        if report_path:
+            writes.append(_storage_upload("papers", report_path, report_text.encode('utf-8'), "text/markdown"))
+        await asyncio.gather(*writes)
+        read_cache.invalidate(_submissions_namespace(paper_id))
+    version = _schedule_edit(("student_submissions", str(student_id)), (new_score, new_report_text), write)
+    return version, paper_id
+
+async def get_student_report_text(student_id):
+    """Downloads a submission's evaluation report markdown. Returns None if it or its file is missing."""
+    pending = _pending_edit(("student_submissions", str(student_id)))
+    if pending is not None:
+        return pending[1]
+    found = await _submission_paths(student_id)
+    return await _download_text(found[1]) if found and found[1] else None
+
+async def get_student_submissions(paper_id, limit=None, cursor=None, columns=None):
+    return await _cached_list_page(
+        _submissions_namespace(paper_id), "student_submissions", {"paper_id": f"eq.{paper_id}"},
+        limit=limit, cursor=cursor, columns=columns
+    )
 
 # --- UTILS ---
-def delete_from_storage(file_url):
-    if not file_url: return
+async def _download_text(path, bucket_name="papers"):
+    """Reads a stored text file. None if it does not exist."""
+    with span("storage.download"):
+        response = await _http().get(f"/storage/v1/object/public/{bucket_name}/{path}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.text
+
+def _edit_path(file_url, prefix):
+    """Storage path of an editable per-job file ("solutions/<job>.md"), or "" for any other url."""
+    if file_url and prefix in file_url:
+        return prefix + file_url.split(prefix)[-1]
+    return ""
+
+def _storage_path(file_url, bucket_name="papers"):
+    if file_url and f"/{bucket_name}/" in file_url:
+        return file_url.split(f"/{bucket_name}/")[-1]
+    return None
+
+async def _remove_released(bucket_name, paths):
+    # Re-checked at send time: an upload that was already in flight keeps the object it is about to reference
+    paths = [
+        path for path in paths
+        if (bucket_name, path) not in _pending_blobs and not blob_index.referenced(bucket_name, path)
+    ]
+    if not paths: return
     try:
-        bucket_name = "papers"
-        if f"/{bucket_name}/" in file_url:
-            path = file_url.split(f"/{bucket_name}/")[-1]
-            supabase.storage.from_(bucket_name).remove([path])
+        await _storage_remove(bucket_name, paths)
     except Exception as e:
-        print(f"Error deleting file {file_url}: {e}")
-
-def delete_paper_record(paper_id):
-    data = supabase.table('solutions').select("*").eq('id', paper_id).execute()
-    if not data.data: return
-
-    paper = data.data[0]
-    
-    students = supabase.table('student_submissions').select("*").eq('paper_id', paper_id).execute()
-    for student in students.data:
-        delete_from_storage(student.get('submission_url'))
-        delete_from_storage(student.get('report_url'))
-    
-    supabase.table('student_submissions').delete().eq('paper_id', paper_id).execute()
-
-    delete_from_storage(paper.get('original_url'))
-    delete_from_storage(paper.get('solution_url'))
-
-    supabase.table('solutions').delete().eq('id', paper_id).execute()
-
-def delete_student_record(student_id):
-    data = supabase.table('student_submissions').select("*").eq('id', student_id).execute()
-    if not data.data: return
-    
-    student = data.data[0]
-    delete_from_storage(student.get('submission_url'))
-    delete_from_storage(student.get('report_url'))
-    
-    supabase.table('student_submissions').delete().eq('id', student_id).execute()
\ No newline at end of file
+        print(f"Error deleting files {paths}: {e}")
+
+async def delete_from_storage(*file_urls):
+    """
+    Removes any number of stored files with a single Storage request. Shared objects go with their last reference.
+    Each released path is held in _removing_blobs until Storage has answered, so it is not re-referenced meanwhile.
+    """
+    paths = [path for path in map(_storage_path, file_urls) if path and blob_index.release("papers", path)]
+    if not paths: return
+    keys = [("papers", path) for path in paths]
+    task = asyncio.ensure_future(_remove_released("papers", paths))
+    for key in keys:
+        _removing_blobs[key] = task
+
+    def done(_):
+        for key in keys:
+            if _removing_blobs.get(key) is task:
+                del _removing_blobs[key]
+    task.add_done_callback(done)
+    await asyncio.shield(task)
+
+async def delete_paper_record(paper_id):
+    """Deletes a paper and its submissions: two row deletes and one storage call."""
+    students = await _table("DELETE", "student_submissions", params={
+        "paper_id": f"eq.{paper_id}", "select": "id,submission_url,report_url"
+    }, returning=True)
+    papers = await _table("DELETE", "solutions", params={
+        "id": f"eq.{paper_id}", "select": "original_url,solution_url"
+    }, returning=True)
+    read_cache.invalidate("solutions")
+    read_cache.invalidate(_submissions_namespace(paper_id))
+    _drop_edit(("solutions", str(paper_id)))
+    for row in students:
+        _drop_edit(("student_submissions", str(row["id"])))
+
+    await delete_from_storage(
+        *(row.get('original_url') for row in papers),
+        *(row.get('solution_url') for row in papers),
+        *(row.get('submission_url') for row in students),
+        *(row.get('report_url') for row in students)
+    )
+
+async def delete_student_record(student_id):
+    rows = await _table("DELETE", "student_submissions", params={
+        "id": f"eq.{student_id}", "select": "paper_id,submission_url,report_url"
+    }, returning=True)
+    for student in rows:
+        read_cache.invalidate(_submissions_namespace(student["paper_id"]))
+    _drop_edit(("student_submissions", str(student_id)))
+    await delete_from_storage(
+        *(row.get('submission_url') for row in rows), *(row.get('report_url') for row in rows)
+    )
+
+# --- DEFERRED DELETES (tombstone now, purge later) ---
+DEFERRED_DELETES = os.getenv("DEFERRED_DELETES", "0") == "1"
+
+_tombstones = set()  # (table, id) hidden from reads until the purge finishes
+_purge_tasks = set()
+
+def _hide_tombstoned(table, rows):
+    if not _tombstones:
+        return rows
+    return [row for row in rows if (table, str(row.get("id"))) not in _tombstones]
+
+def defer_delete(table, row_id, purge):
+    """
+    Hides the row from list reads right away and runs the `purge` coroutine in the background.
+    If the purge fails the row becomes visible again so the delete can be retried.
+    """
+    tombstone = (table, str(row_id))
+    _tombstones.add(tombstone)
+
+    async def run():
+        try:
+            await purge
+        except Exception as e:
+            print(f"Deferred delete of {table}/{row_id} failed: {e}")
+        finally:
+            _tombstones.discard(tombstone)
+
+    task = asyncio.create_task(run())
+    _purge_tasks.add(task)
+    task.add_done_callback(_purge_tasks.discard)
+
+async def drain_deferred_deletes():
+    """Waits for in-flight purges. Called at shutdown."""
+    if _purge_tasks:
+        await asyncio.gather(*_purge_tasks, return_exceptions=True)
+
+# --- WRITE-BEHIND EDITS (accept now, write once the editor pauses) ---
+# Edits to one record are coalesced: only the newest text is written, AUTOSAVE_DELAY after the
+# last edit (at most AUTOSAVE_MAX_DELAY after the first unsaved one), and pending edits are
+# flushed at shutdown. Storage paths are cached per record so an edit needs no lookups.
+AUTOSAVE_DELAY = float(os.getenv("AUTOSAVE_DELAY", "1.5"))
+AUTOSAVE_MAX_DELAY = float(os.getenv("AUTOSAVE_MAX_DELAY", "10"))
+AUTOSAVE_RETRY_DELAY = float(os.getenv("AUTOSAVE_RETRY_DELAY", "5"))
+AUTOSAVE_ATTEMPTS = int(os.getenv("AUTOSAVE_ATTEMPTS", "5"))
+STORAGE_PATH_CACHE_SIZE = int(os.getenv("STORAGE_PATH_CACHE_SIZE", "10000"))
+
+storage_paths = TTLCache(STORAGE_PATH_CACHE_SIZE, float("inf"))  # (table, id) -> path(s); they never change
+_edits = {}  # (table, id) -> pending edit state
+_last_version = 0
+
+def _next_version():
+    """Millisecond clock, bumped so versions stay increasing within this worker."""
+    global _last_version
+    _last_version = max(_last_version + 1, int(time.time() * 1000))
+    return _last_version
+
+def _schedule_edit(key, value, write, on_saved=None):
+    """
+    Records `value` as the newest edit of `key` and makes sure a flush is pending. Returns its version.
+    `on_saved(value)` runs once that value (or a newer one) is written.
+    """
+    now = time.monotonic()
+    edit = _edits.get(key)
+    if edit is None:
+        edit = _edits[key] = {"saved_version": 0, "first": now, "task": None, "now": asyncio.Event(), "error": None}
+    edit.update(version=_next_version(), value=value, write=write, on_saved=on_saved, last=now, failed=False)
+    if edit["first"] is None:
+        edit["first"] = now
+    if edit["task"] is None:
+        edit["task"] = asyncio.create_task(_flush_edit(key, edit))
+    return edit["version"]
+
+def _pending_edit(key):
+    edit = _edits.get(key)
+    return None if edit is None else edit["value"]
+
+def _drop_edit(key):
+    """Forgets a deleted record: its pending edit is not written and its cached path goes."""
+    edit = _edits.pop(key, None)
+    if edit is not None and edit["task"] is not None:
+        edit["task"].cancel()
+    storage_paths.pop(key)
+
+async def _flush_edit(key, edit):
+    attempts = 0
+    try:
+        while edit["saved_version"] < edit["version"]:
+            # Debounce: wait for a pause in the edits, unless a flush was requested
+            while not edit["now"].is_set():
+                wait = min(edit["last"] + AUTOSAVE_DELAY, edit["first"] + AUTOSAVE_MAX_DELAY) - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(edit["now"].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            version, value = edit["version"], edit["value"]
+            edit["first"] = None
+            try:
+                with span(f"autosave.{key[0]}"):
+                    await edit["write"](value)
+            except Exception as e:
+                attempts += 1
+                edit["error"] = str(e)
+                print(f"Autosave of {key[0]}/{key[1]} v{version} failed (attempt {attempts}): {e}")
+                if attempts >= AUTOSAVE_ATTEMPTS or edit["now"].is_set():
+                    # Given up until the next edit; edit_status reports it
+                    edit["failed"] = True
+                    return
+                edit["first"] = edit["first"] or time.monotonic()
+                await asyncio.sleep(AUTOSAVE_RETRY_DELAY * attempts)
+                continue
+            attempts = 0
+            edit["saved_version"], edit["error"] = version, None
+            if edit["on_saved"] is not None:
+                try:
+                    await edit["on_saved"](value)
+                except Exception as e:
+                    print(f"After-save hook of {key[0]}/{key[1]} v{version} failed: {e}")
+    finally:
+        edit["task"] = None
+        if _edits.get(key) is edit and edit["saved_version"] >= edit["version"]:
+            del _edits[key]
+
+def edit_status(table, row_id):
+    """
+    Autosave state of one record: the newest accepted version, the newest written one and the last error.
+    `failed` means the write was given up on; the edit is kept and retried with the next one.
+    """
+    edit = _edits.get((table, str(row_id)))
+    if edit is None:
+        return {"pending": False}
+    return {
+        "pending": True, "version": edit["version"], "saved_version": edit["saved_version"] or None,
+        "error": edit["error"], "failed": edit["failed"]
+    }
+
+async def flush_edits():
+    """Writes every pending edit now. Called at shutdown."""
+    for key, edit in list(_edits.items()):
+        edit["now"].set()
+        if edit["task"] is None:
+            edit["task"] = asyncio.create_task(_flush_edit(key, edit))
+    tasks = [edit["task"] for edit in _edits.values() if edit["task"] is not None]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
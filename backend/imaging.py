@@ -0,0 +1,138 @@
+import os
+import io
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps, ImageStat
+
+# PDF rasterization runs on a process pool so it never blocks the event loop
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_LOOKAHEAD = int(os.getenv("RENDER_LOOKAHEAD", "2"))
+RENDER_SCALE = 2  # upper bound; pages are rendered straight to IMAGE_MAX_SIDE
+
+# Payload optimization applied to every page before it is sent to the model
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "1") == "1"
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+BLANK_PAGE_STDDEV = float(os.getenv("BLANK_PAGE_STDDEV", "3.0"))
+
+_render_pool = None
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # spawn: forking a threaded uvicorn worker is not safe
+        _render_pool = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _render_pool
+
+def shutdown_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+# --- WORKER FUNCTIONS (run in the pool processes) ---
+def _count_pages(path):
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def _render_page(path, index, scale):
+    """Renders one page at the target resolution and returns its model payload (None if blank)."""
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(path)
+    try:
+        page = pdf[index]
+        width, height = page.get_size()
+        scale = min(scale, IMAGE_MAX_SIDE / max(width, height))
+        return prepare_image(page.render(scale=scale).to_pil())
+    finally:
+        pdf.close()
+
+# --- PAYLOAD OPTIMIZATION ---
+def is_blank(img):
+    """A page with almost no contrast has nothing worth sending to the model."""
+    thumb = img.convert("L")
+    thumb.thumbnail((256, 256))
+    return ImageStat.Stat(thumb).stddev[0] < BLANK_PAGE_STDDEV
+
+def prepare_image(item):
+    """
+    Downscales, converts and re-encodes a page for the model.
+    Accepts a PIL image, a path or BytesIO/bytes of an uploaded photo, or an already prepared payload.
+    Returns {"mime_type", "data"} or None for a blank page.
+    """
+    if item is None or isinstance(item, dict):
+        return item
+    if isinstance(item, (bytes, bytearray)):
+        item = io.BytesIO(item)
+    if isinstance(item, (str, io.BytesIO)):
+        if isinstance(item, io.BytesIO):
+            item.seek(0)
+        img = Image.open(item)
+        # JPEG photos decode straight at (about) the target size instead of full resolution
+        img.draft(img.mode, (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        item = ImageOps.exif_transpose(img)
+
+    if is_blank(item):
+        return None
+
+    img = item.copy() if item.width > IMAGE_MAX_SIDE or item.height > IMAGE_MAX_SIDE else item
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    img = img.convert("L") if IMAGE_GRAYSCALE else img.convert("RGB")
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    return {"mime_type": f"image/{IMAGE_FORMAT.lower()}", "data": buffer.getvalue()}
+
+# --- API ---
+def remove_spooled(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def count_pdf_pages(path):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_render_pool(), _count_pages, path)
+
+def iter_pdf_pages(path, page_count, lookahead=None, indices=None):
+    """
+    Lazily yields one render Future per page, in order.
+    Pass `indices` to render only some (0-based) pages.
+    At most `lookahead` renders are queued ahead of what the consumer has pulled,
+    so a long PDF never sits fully rasterized in memory.
+    """
+    pool = get_render_pool()
+    lookahead = max(1, lookahead or RENDER_LOOKAHEAD)
+    indices = iter(range(page_count) if indices is None else indices)
+    pending = deque()
+    next_index = next(indices, None)
+    try:
+        while next_index is not None or pending:
+            while next_index is not None and len(pending) < lookahead:
+                pending.append(pool.submit(_render_page, path, next_index, RENDER_SCALE))
+                next_index = next(indices, None)
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def render_pdf(path, page_count=None):
+    """Renders every page of a PDF on the pool. Used where all pages are needed at once.
+    Blank pages come back as None."""
+    loop = asyncio.get_running_loop()
+    if not page_count:
+        page_count = await count_pdf_pages(path)
+    pool = get_render_pool()
+    return list(await asyncio.gather(*[
+        loop.run_in_executor(pool, _render_page, path, index, RENDER_SCALE)
+        for index in range(page_count)
+    ]))
@@ -0,0 +1,497 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+from starlette.concurrency import iterate_in_threadpool
+from imaging import count_pdf_pages, iter_pdf_pages
+from solver import solve_pages, format_page_solution, current_teacher
+from db import upload_bytes_to_supabase, upload_file_deduplicated, save_record, delete_from_storage, public_url
+from uploads import move_spooled
+from references import reference_store
+from questionbank import question_bank
+from cache import DATA_DIR, Lazy, open_store
+from metrics import span, start_timings
+
+# Durable /solve queue: jobs, per-page checkpoints and the event log live in SQLite,
+# uploaded files next to it, so a restart resumes from the last finished page.
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.sqlite3")
+JOB_FILES_DIR = os.path.join(DATA_DIR, "jobs")
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))      # whole-job retries (uploads, DB)
+JOB_PAGE_ATTEMPTS = int(os.getenv("JOB_PAGE_ATTEMPTS", "3"))    # model attempts per page
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))  # while a worker holds a job
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "90"))           # running jobs without a heartbeat are reclaimed
+JOB_POLL_SECONDS = 1.0
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+class JobStore:
+    """SQLite persistence for solve jobs. All methods are short and safe to call from the event loop."""
+
+    def __init__(self, path):
+        self.lock, self.conn = open_store(path, """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                total_pages INTEGER,
+                original_url TEXT,
+                paper_id TEXT,
+                teacher TEXT,
+                claim TEXT,
+                error TEXT,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, available_at);
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT,
+                path TEXT NOT NULL,
+                page_count INTEGER,
+                PRIMARY KEY (job_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS job_pages (
+                job_id TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                text TEXT,
+                error TEXT,
+                PRIMARY KEY (job_id, page)
+            );
+            CREATE TABLE IF NOT EXISTS job_events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+        """)
+        # Job stores created before jobs carried their teacher and claim
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("teacher", "claim"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def create_job(self, name, files, teacher=None):
+        """Moves the spooled upload files (see uploads.spool_upload) into the job directory and queues the job."""
+        job_id = str(uuid.uuid4())
+        job_dir = os.path.join(JOB_FILES_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        now = time.time()
+        rows = []
+        for idx, f in enumerate(files):
+            move_spooled(f, os.path.join(job_dir, f"{idx}_{os.path.basename(f['filename'] or 'upload')}"))
+            rows.append((job_id, idx, f["filename"], f["content_type"], f["path"], f["page_count"]))
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO job_files (job_id, idx, filename, content_type, path, page_count) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.execute(
+                "INSERT INTO jobs (id, name, status, teacher, available_at, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, name, teacher, now, now, now)
+            )
+        return job_id
+
+    def claim_next(self):
+        """
+        Atomically takes the oldest runnable job (queued, or running with a stale heartbeat).
+        The returned job's `claim` token identifies this run; see heartbeat().
+        """
+        now = time.time()
+        rows = self._execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, claim = ?, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND updated_at < ?)
+                ORDER BY created_at LIMIT 1
+            )
+            RETURNING *
+        """, (str(uuid.uuid4()), now, now, now - JOB_STALE_SECONDS))
+        return dict(rows[0]) if rows else None
+
+    def heartbeat(self, job_id, claim):
+        """Refreshes a running job's heartbeat. False once another worker has reclaimed it."""
+        return bool(self._execute(
+            "UPDATE jobs SET updated_at = ? WHERE id = ? AND claim = ? AND status = 'running' RETURNING id",
+            (time.time(), job_id, claim)
+        ))
+
+    def owns(self, job_id, claim):
+        rows = self._execute("SELECT claim FROM jobs WHERE id = ?", (job_id,))
+        return bool(rows) and rows[0]["claim"] == claim
+
+    def release(self, job_id, claim):
+        """Puts a job back in the queue at once (shutdown), without counting the interrupted attempt."""
+        self._execute(
+            "UPDATE jobs SET status = 'queued', claim = NULL, attempts = MAX(attempts - 1, 0), available_at = ?, "
+            "updated_at = ? WHERE id = ? AND claim = ? AND status = 'running'",
+            (time.time(), time.time(), job_id, claim)
+        )
+
+    def set_original(self, job_id, original_url):
+        """Records the job's original once. False if another attempt already recorded one."""
+        return bool(self._execute(
+            "UPDATE jobs SET original_url = ?, updated_at = ? WHERE id = ? AND original_url IS NULL RETURNING id",
+            (original_url, time.time(), job_id)
+        ))
+
+    def update_job(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        self._execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get_job(self, job_id):
+        rows = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def get_files(self, job_id):
+        return [dict(row) for row in self._execute("SELECT * FROM job_files WHERE job_id = ? ORDER BY idx", (job_id,))]
+
+    def set_page_count(self, job_id, idx, page_count):
+        self._execute("UPDATE job_files SET page_count = ? WHERE job_id = ? AND idx = ?", (page_count, job_id, idx))
+
+    def init_pages(self, job_id, total_pages):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO job_pages (job_id, page) VALUES (?, ?)",
+                [(job_id, page) for page in range(1, total_pages + 1)]
+            )
+
+    def get_pages(self, job_id):
+        return [dict(row) for row in self._execute("SELECT * FROM job_pages WHERE job_id = ? ORDER BY page", (job_id,))]
+
+    def checkpoint_page(self, job_id, page, text, error, final=False):
+        """Records one page attempt; `final` failures are not retried."""
+        status = "failed" if error is not None else "done"
+        self._execute(
+            "UPDATE job_pages SET status = ?, attempts = CASE WHEN ? THEN ? ELSE attempts + 1 END, text = ?, error = ? "
+            "WHERE job_id = ? AND page = ?",
+            (status, final, JOB_PAGE_ATTEMPTS, text, error, job_id, page)
+        )
+
+    def append_event(self, job_id, payload):
+        with self.lock:
+            seq = self.conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM job_events WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            self.conn.execute(
+                "INSERT INTO job_events (job_id, seq, payload) VALUES (?, ?, ?)", (job_id, seq, json.dumps(payload))
+            )
+        return seq
+
+    def get_events(self, job_id, offset=0):
+        rows = self._execute(
+            "SELECT seq, payload FROM job_events WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, offset)
+        )
+        return [(row["seq"], json.loads(row["payload"])) for row in rows]
+
+job_store = Lazy(lambda: JobStore(JOBS_DB_PATH))
+
+# --- SIGNALS (created on the running loop by start_job_workers) ---
+_queue_signal: asyncio.Event = None
+_events_changed: asyncio.Condition = None
+_workers = []
+
+async def _emit(job_id, payload):
+    job_store.append_event(job_id, payload)
+    if _events_changed is not None:
+        async with _events_changed:
+            _events_changed.notify_all()
+
+async def enqueue_solve(name, files):
+    """Queues a solve job for the spooled upload files. Returns the job id."""
+    job_id = await asyncio.to_thread(job_store.create_job, name, files, current_teacher.get())
+    await _emit(job_id, {"status": "queued", "job_id": job_id})
+    if _queue_signal is not None:
+        _queue_signal.set()
+    return job_id
+
+async def stream_job_events(job_id, offset=0, timings=False):
+    """
+    Yields NDJSON lines for a job's events from `offset` on, until the job finishes.
+    The per-stage timing trailer on the final event is only included with `timings`.
+    """
+    while True:
+        for seq, payload in job_store.get_events(job_id, offset):
+            offset = seq + 1
+            if not timings:
+                payload.pop("timings", None)
+            yield json.dumps({**payload, "offset": seq}) + "\n"
+            if payload.get("status") in TERMINAL_STATUSES:
+                return
+        job = job_store.get_job(job_id)
+        if job is None or job["status"] in TERMINAL_STATUSES:
+            return
+        if _events_changed is None:
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            continue
+        async with _events_changed:
+            try:
+                await asyncio.wait_for(_events_changed.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+def job_summary(job_id):
+    job = job_store.get_job(job_id)
+    if job is None:
+        return None
+    job.pop("claim", None)
+    pages = job_store.get_pages(job_id)
+    job["pages_done"] = sum(1 for page in pages if page["status"] == "done")
+    job["pages_failed"] = [page["page"] for page in pages if page["status"] == "failed"]
+    job["events"] = len(job_store.get_events(job_id))
+    return job
+
+# --- WORKER ---
+class ClaimLostError(Exception):
+    """The job was reclaimed by another worker while this one was still running it."""
+
+def _check_claim(job):
+    if not job_store.heartbeat(job["id"], job["claim"]):
+        raise ClaimLostError(f"Job {job['id']} was reclaimed by another worker")
+
+async def _keep_alive(job):
+    """Heartbeat for the whole run, so slow pages, queued model calls or long uploads never look stale."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        if not job_store.heartbeat(job["id"], job["claim"]):
+            print(f"Job {job['id']} lost its claim to another worker")
+            return
+
+def _page_stream(files, wanted):
+    """Yields (page_number, image) for the wanted global page numbers across all job files."""
+    offset = 0
+    for f in files:
+        page_count = f["page_count"] or 0
+        numbers = [n for n in range(offset + 1, offset + page_count + 1) if n in wanted]
+        if numbers and f["content_type"] == "application/pdf":
+            renders = iter_pdf_pages(f["path"], page_count, indices=[n - offset - 1 for n in numbers])
+            yield from zip(numbers, renders)
+        elif numbers:
+            # Decoded from the file when the page is prepared
+            yield numbers[0], f["path"]
+        offset += page_count
+
+def _solution_path(job_id):
+    return f"solutions/{job_id}.md"
+
+async def _upload_original(job_id, f):
+    with span("job.upload_original"):
+        return await upload_file_deduplicated(f["path"], "papers", f["filename"], f["content_type"])
+
+async def _finish_uploads(job_id, files, uploads):
+    """
+    Waits for the original uploads. Returns (url of the first file, [upload errors]); the url is None if nothing was uploaded.
+    Only the first file is kept on the job (and later the solutions row), so the other files' blob references are dropped.
+    """
+    if not uploads:
+        return None, []
+    with span("job.upload_wait"):
+        results = await asyncio.gather(*uploads, return_exceptions=True)
+    uploads.clear()  # the results are handled here from now on, not by _drop_uploads
+    upload_errors = []
+    for f, result in zip(files, results):
+        if isinstance(result, Exception):
+            print(f"Upload of {f['filename']} failed for job {job_id}: {result}")
+            upload_errors.append({"file": f["filename"], "error": str(result)})
+    first = results[0]
+    original_url = "" if isinstance(first, Exception) else first
+    unused = [result for result in results[1:] if isinstance(result, str)]
+    if not job_store.set_original(job_id, original_url):
+        # A reclaimed copy of this job got there first; keep its upload
+        unused.append(original_url)
+        original_url = job_store.get_job(job_id)["original_url"]
+    await delete_from_storage(*unused)
+    return original_url, upload_errors
+
+async def _drop_uploads(uploads):
+    """Cancels original uploads that will not be recorded and releases any that already finished."""
+    for task in uploads:
+        task.cancel()
+    if not uploads:
+        return
+    await asyncio.wait(uploads)
+    finished = [task.result() for task in uploads if not task.cancelled() and task.exception() is None]
+    await asyncio.shield(delete_from_storage(*finished))
+
+async def _solve_job(job_id, files):
+    """Counts, solves and checkpoints every page. Returns (solution_text, pages)."""
+    # Count pages (once per file)
+    for f in files:
+        if f["page_count"] is not None:
+            continue
+        page_count = 1
+        if f["content_type"] == "application/pdf":
+            try:
+                with span("job.count_pages"):
+                    page_count = await count_pdf_pages(f["path"])
+            except Exception as e:
+                print(f"Error converting PDF {f['filename']}: {e}")
+                page_count = 0
+        f["page_count"] = page_count
+        job_store.set_page_count(job_id, f["idx"], page_count)
+
+    total_pages = sum(f["page_count"] for f in files)
+    if not total_pages:
+        raise ValueError("No valid images or PDFs processed.")
+    job_store.init_pages(job_id, total_pages)
+    job_store.update_job(job_id, total_pages=total_pages)
+
+    # Solve every page without a checkpoint; failed pages are retried on their own
+    for attempt in range(JOB_PAGE_ATTEMPTS):
+        wanted = {
+            page["page"] for page in job_store.get_pages(job_id)
+            if page["status"] != "done" and page["attempts"] < JOB_PAGE_ATTEMPTS
+        }
+        if not wanted:
+            break
+        if attempt:
+            print(f"Retrying {len(wanted)} page(s) of job {job_id}")
+            await asyncio.sleep(JOB_RETRY_DELAY * attempt)
+        async for page_number, page_content, error in iterate_in_threadpool(solve_pages(_page_stream(files, wanted))):
+            if error is None:
+                job_store.checkpoint_page(job_id, page_number, page_content, None)
+            else:
+                # Fatal model errors (bad request, blocked content) won't improve on retry
+                job_store.checkpoint_page(
+                    job_id, page_number, None, str(error), final=not getattr(error, "retryable", True)
+                )
+            if attempt:
+                # Its own event, so solving_page progress never goes backwards
+                await _emit(job_id, {"status": "retrying_page", "page": page_number, "attempt": attempt + 1, "total": total_pages})
+            else:
+                await _emit(job_id, {"status": "solving_page", "current": page_number, "total": total_pages})
+
+    # Assemble the solution from the checkpoints
+    pages = job_store.get_pages(job_id)
+    solution_text = "".join(
+        format_page_solution(page["page"], page["text"], page["error"] if page["status"] == "failed" else None)
+        for page in pages
+    )
+    return solution_text, pages
+
+async def _run_job(job):
+    job_id = job["id"]
+    timings = start_timings()
+    # Page requests queue as bulk work of the teacher who uploaded the paper
+    current_teacher.set(job["teacher"])
+    files = job_store.get_files(job_id)
+    print(f"Solving Paper: {job['name']} with {len(files)} file(s) (job {job_id}, attempt {job['attempts']})")
+
+    # Upload originals (once per job) in the background while pages are rendered and solved
+    uploads = []
+    if job["original_url"] is None:
+        uploads = [asyncio.create_task(_upload_original(job_id, f)) for f in files]
+    try:
+        with span("job.solve"):
+            solution_text, pages = await _solve_job(job_id, files)
+        original_url, upload_errors = await _finish_uploads(job_id, files, uploads)
+    except BaseException:
+        await _drop_uploads(uploads)
+        raise
+    if original_url is None:
+        original_url = job["original_url"]
+
+    # Upload and record the solution once every original upload has settled
+    try:
+        solution_url = await upload_bytes_to_supabase(
+            solution_text.encode('utf-8'), "papers", _solution_path(job_id), "text/markdown"
+        )
+    except Exception as e:
+        print(f"Solution upload failed for job {job_id}: {e}")
+        upload_errors.append({"file": _solution_path(job_id), "error": str(e)})
+        solution_url = ""
+    # Only the worker still holding the job records it
+    _check_claim(job)
+    paper_id = job_store.get_job(job_id)["paper_id"]
+    if paper_id is None:
+        paper_id = await save_record(job["name"], original_url, solution_url)
+        job_store.update_job(job_id, paper_id=paper_id)
+    if paper_id is not None:
+        # Per-question index so /evaluate can load the reference by paper_id
+        await asyncio.to_thread(reference_store.save, paper_id, solution_text)
+        await asyncio.to_thread(question_bank.add_solved, paper_id, solution_text)
+
+    job_store.update_job(job_id, status="completed")
+    await _emit(job_id, {
+        "status": "completed",
+        "job_id": job_id,
+        "paper_id": paper_id,
+        "original_url": original_url,
+        "solution_url": solution_url,
+        "solution_text": solution_text,
+        "failed_pages": [page["page"] for page in pages if page["status"] == "failed"],
+        "upload_errors": upload_errors,
+        "timings": timings.summary()
+    })
+
+async def _worker_loop():
+    while True:
+        job = job_store.claim_next()
+        if job is None:
+            _queue_signal.clear()
+            try:
+                await asyncio.wait_for(_queue_signal.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id = job["id"]
+        heartbeat = asyncio.create_task(_keep_alive(job))
+        try:
+            await _run_job(job)
+        except asyncio.CancelledError:
+            # Shutting down: back in the queue, for the next start to pick up straight away
+            job_store.release(job_id, job["claim"])
+            raise
+        except ClaimLostError as e:
+            print(f"{e}; leaving it to that worker")
+            continue
+        except Exception as e:
+            print(f"Job {job_id} failed (attempt {job['attempts']}): {e}")
+            if not job_store.owns(job_id, job["claim"]):
+                continue
+            if job["attempts"] < JOB_MAX_ATTEMPTS and not isinstance(e, ValueError):
+                job_store.update_job(
+                    job_id, status="queued", error=str(e), available_at=time.time() + JOB_RETRY_DELAY * job["attempts"]
+                )
+                continue
+            job_store.update_job(job_id, status="failed", error=str(e))
+            failed = job_store.get_job(job_id)
+            if failed["paper_id"] is None:
+                # No solutions row took over the original's blob reference, or the solution uploaded before the failure
+                await delete_from_storage(failed["original_url"], public_url("papers", _solution_path(job_id)))
+            await _emit(job_id, {"status": "failed", "job_id": job_id, "error": str(e)})
+        finally:
+            heartbeat.cancel()
+
+        if job_store.owns(job_id, job["claim"]):
+            shutil.rmtree(os.path.join(JOB_FILES_DIR, job_id), ignore_errors=True)
+
+async def start_job_workers():
+    global _queue_signal, _events_changed
+    _queue_signal = asyncio.Event()
+    _events_changed = asyncio.Condition()
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.create_task(_worker_loop()))
+
+async def stop_job_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
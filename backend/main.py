@@ -1,29 +1,119 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
 import uuid
-import io
+import time
+import os
+import re
 import json
+import asyncio
+import zipfile
+import mimetypes
 from typing import List, Optional
-from datetime import datetime
-import pypdfium2 as pdfium 
+from dotenv import load_dotenv
+
+# Once, before the modules below read their settings from the environment
+load_dotenv()
+
+from imaging import render_pdf, prepare_image, shutdown_render_pool
 from solver import (
-    get_latex_solution_stream, evaluate_student_solution, extract_score, 
-    generate_paper
+    evaluate_student_solution, extract_score, ModelCallError, model_call_stats, current_teacher,
+    generate_paper, evaluate_student_solution_stream, generate_paper_stream, generate_questions
 )
 from db import (
-    upload_bytes_to_supabase, save_record, get_records, 
-    save_student_submission, get_student_submissions,
-    delete_paper_record, delete_student_record,
-    update_paper_solution, update_student_submission,
-    save_generated_paper, get_generated_papers, delete_generated_paper
+    init_db, close_db, upload_bytes_to_supabase, upload_bytes_deduplicated, upload_file_deduplicated, get_records,
+    save_student_submission, save_student_submissions, get_student_submissions,
+    delete_paper_record, delete_student_record, delete_from_storage,
+    update_paper_solution, update_student_submission, get_paper_solution_text,
+    get_generated_paper_text, get_student_report_text,
+    save_generated_paper, get_generated_papers, delete_generated_paper, read_cache,
+    DEFERRED_DELETES, defer_delete, drain_deferred_deletes, flush_edits, edit_status
+)
+from cache import solution_cache, pdf_cache
+from pdfs import markdown_to_pdf, pdf_cache_key, PdfRenderError
+from blobs import blob_index
+from metrics import span, render_metrics, HTTP_REQUEST_SECONDS
+from analytics import grade_store, compute_paper_analytics
+from references import reference_store, parse_solution, parse_question_selection, render_reference
+from questionbank import question_bank, assemble_paper
+from uploads import (
+    spool_upload, spool_file, count_pages, estimate_memory, discard, upload_memory,
+    format_size, UploadLimitError, UploadRoute, UPLOAD_MAX_REQUEST_BYTES, UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_FILES,
+    UPLOAD_QUEUE_SECONDS
 )
+from jobs import enqueue_solve, stream_job_events, job_summary, start_job_workers, stop_job_workers
 from pydantic import BaseModel
 
-app = FastAPI()
+def _model_error_status(e):
+    """503 when the model may recover (quota, overload, open circuit), 502 when the request itself failed."""
+    return 503 if e.retryable else 502
+
+def _upload_error(e):
+    """413 for an upload over a size or page limit, 503 while the worker has no memory to spare for it."""
+    if e.retryable:
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    return HTTPException(status_code=413, detail=str(e))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    await start_job_workers()
+    yield
+    await stop_job_workers()
+    # Batches still grading stop here; their finished scripts are saved before the client closes
+    batches = list(_batches)
+    for task in batches:
+        task.cancel()
+    await asyncio.gather(*batches, return_exceptions=True)
+    await flush_edits()
+    await drain_deferred_deletes()
+    await close_db()
+    shutdown_render_pool()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = UploadRoute  # multipart uploads go straight to UPLOAD_DIR (see uploads.py)
+
+# Scripts graded at once by /evaluate/batch, and how often its results are saved
+EVAL_BATCH_CONCURRENCY = int(os.getenv("EVAL_BATCH_CONCURRENCY", "4"))
+EVAL_BATCH_SAVE_ROWS = int(os.getenv("EVAL_BATCH_SAVE_ROWS", "10"))
+EVAL_BATCH_SAVE_SECONDS = float(os.getenv("EVAL_BATCH_SAVE_SECONDS", "2"))
+EVAL_BATCH_SAVE_ATTEMPTS = 3
+_batches = set()  # running /evaluate/batch tasks
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    # Refused before the multipart body is parsed and spooled
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > UPLOAD_MAX_REQUEST_BYTES:
+        return JSONResponse(
+            status_code=413, content={"detail": f"Request exceeds {format_size(UPLOAD_MAX_REQUEST_BYTES)}"}
+        )
+    return await call_next(request)
+
+@app.middleware("http")
+async def identify_teacher(request: Request, call_next):
+    # Model calls made for this request share the scheduler fairly per teacher (see solver.ModelScheduler)
+    teacher = request.headers.get("x-teacher-id") or (request.client.host if request.client else None)
+    current_teacher.set(teacher)
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.monotonic()
+    response = await call_next(request)
+    # Route template, not the raw path, so ids don't explode the label set
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(time.monotonic() - started)
+    return response
 
+# Added last so it is the outermost layer: responses short-circuited by the middleware
+# above (the 413 from limit_request_size) still get CORS headers
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # --- Pydantic Models ---
@@ -42,218 +132,820 @@ class GenerateRequest(BaseModel):
     paper_type: str 
     chapters: List[str]
     difficulty: int
+    mode: str = "model"  # "bank": assemble from the question bank, the model writes only missing questions
 
 @app.post("/solve")
-async def solve_paper(files: List[UploadFile] = File(...), name: str = Form(...)):
-    print(f"Solving Paper: {name} with {len(files)} file(s)")
-    job_id = str(uuid.uuid4())
-    
-    # 1. Pre-process all files into images
-    processed_images = []
-    original_url = "" 
-    
+async def solve_paper(files: List[UploadFile] = File(...), name: str = Form(...), timings: bool = Form(False)):
+    """
+    Queues the paper on the durable job queue and streams the job's progress events.
+    With `timings`, the final event carries per-stage durations and token counts.
+    """
+    uploads = await _spool_uploads(files)
     try:
-        for i, file in enumerate(files):
-            file_bytes = await file.read()
-            url = upload_bytes_to_supabase(
-                file_bytes, "papers", f"originals/{job_id}_{i}_{file.filename}", file.content_type
-            )
-            if i == 0: original_url = url
-
-            if file.content_type == "application/pdf":
-                try:
-                    pdf = pdfium.PdfDocument(file_bytes)
-                    for page in pdf:
-                        bitmap = page.render(scale=2) 
-                        pil_image = bitmap.to_pil()
-                        processed_images.append(pil_image)
-                except Exception as e:
-                    print(f"Error converting PDF {file.filename}: {e}")
-            else:
-                processed_images.append(io.BytesIO(file_bytes))
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"File processing error: {e}")
+        await count_pages(uploads)
+    except UploadLimitError as e:
+        discard(uploads)
+        raise _upload_error(e)
+    job_id = await enqueue_solve(name, uploads)
+    print(f"Queued Paper: {name} with {len(files)} file(s) as job {job_id}")
+    return StreamingResponse(stream_job_events(job_id, timings=timings), media_type="application/x-ndjson")
 
-    if not processed_images:
-        raise HTTPException(status_code=400, detail="No valid images or PDFs processed.")
+@app.get("/jobs/{job_id}")
+async def get_job_route(job_id: str):
+    job = job_summary(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-    # 2. Generator for Streaming Response
-    async def solve_generator():
-        solution_text = ""
-        
-        # Stream updates from the solver
-        for current_page, total_pages, current_text in get_latex_solution_stream(processed_images):
-            solution_text = current_text
-            # Yield progress JSON
-            yield json.dumps({
-                "status": "solving_page",
-                "current": current_page,
-                "total": total_pages
-            }) + "\n"
-
-        # Finalize
-        solution_url = ""
-        try:
-            solution_url = upload_bytes_to_supabase(
-                solution_text.encode('utf-8'), "papers", f"solutions/{job_id}.md", "text/markdown"
-            )
-        except Exception:
-            pass
-
-        paper_id = save_record(name, original_url, solution_url)
-
-        # Yield final result
-        yield json.dumps({
-            "status": "completed",
-            "paper_id": paper_id,
-            "original_url": original_url,
-            "solution_url": solution_url,
-            "solution_text": solution_text
-        }) + "\n"
+@app.get("/jobs/{job_id}/events")
+async def job_events_route(job_id: str, offset: int = 0, timings: bool = False):
+    """Streams a job's events from `offset`; reconnect with the last seen offset + 1 to resume."""
+    if job_summary(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(stream_job_events(job_id, offset, timings), media_type="application/x-ndjson")
 
-    return StreamingResponse(solve_generator(), media_type="application/x-ndjson")
+async def _save_generated(req, paper_text):
+    """Uploads a finished paper and records it. Returns (paper_id, file_url)."""
+    # Save file to storage (shared with any identical paper)
+    file_url = await upload_bytes_deduplicated(
+        paper_text.encode('utf-8'), 
+        "papers", 
+        f"{req.name.replace(' ', '_')}.md", 
+        "text/markdown"
+    )
+    
+    # Save to DB with board info
+    try:
+        paper_id = await save_generated_paper(req.name, req.class_level, req.subject, req.board, file_url)
+    except BaseException:
+        await _discard_unsaved(file_url)
+        raise
+    if paper_id is None:
+        await _discard_unsaved(file_url)
+    else:
+        await run_in_threadpool(
+            question_bank.add_generated, paper_id, paper_text, req.board, req.class_level, req.subject, req.chapters, req.difficulty
+        )
+    return paper_id, file_url
 
+def _assemble_from_bank(req):
+    """(paper_text, stats) for a "bank" request, or None when the whole paper has to be written by the model."""
+    if req.mode != "bank":
+        return None
+    write_gaps = lambda gaps: generate_questions(req.class_level, req.subject, req.chapters, req.difficulty, req.board, gaps)
+    with span("generate.bank"):
+        assembled = assemble_paper(req.class_level, req.subject, req.chapters, req.difficulty, req.board, write_gaps)
+    if assembled is None:
+        print(f"Question bank cannot cover {req.board} {req.subject} paper {req.name}, writing it in full")
+    return assembled
 
 @app.post("/generate-paper")
 async def generate_paper_route(req: GenerateRequest):
     print(f"Generating {req.board} {req.subject} paper: {req.name}")
     
     try:
-        paper_text = generate_paper(
-            req.class_level, req.subject, req.chapters, req.difficulty, req.board
-        )
-        
-        # Save file to storage
-        filename = f"generated/{datetime.now().strftime('%Y%m%d%H%M%S')}_{req.name.replace(' ', '_')}.md"
-        file_url = upload_bytes_to_supabase(
-            paper_text.encode('utf-8'), 
-            "papers", 
-            filename, 
-            "text/markdown"
-        )
-        
-        # Save to DB with board info
-        paper_id = save_generated_paper(req.name, req.class_level, req.subject, req.board, file_url)
+        assembled = await run_in_threadpool(_assemble_from_bank, req)
+        if assembled is not None:
+            paper_text, bank = assembled
+        else:
+            paper_text, bank = await run_in_threadpool(
+                generate_paper, req.class_level, req.subject, req.chapters, req.difficulty, req.board
+            ), None
+        paper_id, file_url = await _save_generated(req, paper_text)
         
         return {
             "status": "success",
             "paper_id": paper_id,
             "text": paper_text,
-            "url": file_url
+            "url": file_url,
+            "bank": bank
         }
+    except ModelCallError as e:
+        raise HTTPException(status_code=_model_error_status(e), detail=str(e))
     except Exception as e:
         print(f"Generation Route Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate-paper/stream")
+async def generate_paper_stream_route(req: GenerateRequest):
+    """Like /generate-paper, but streams the paper as NDJSON chunks while the model writes it."""
+    print(f"Generating {req.board} {req.subject} paper: {req.name} (streaming)")
+
+    async def generate_generator():
+        paper_text = ""
+        bank = None
+        try:
+            assembled = await run_in_threadpool(_assemble_from_bank, req)
+            if assembled is not None:
+                # Assembled in one go; sent as a single chunk
+                paper_text, bank = assembled
+                yield json.dumps({"status": "chunk", "text": paper_text}) + "\n"
+            else:
+                async for chunk in iterate_in_threadpool(generate_paper_stream(
+                    req.class_level, req.subject, req.chapters, req.difficulty, req.board
+                )):
+                    paper_text += chunk
+                    yield json.dumps({"status": "chunk", "text": chunk}) + "\n"
+
+            # Persist only once the full paper has arrived
+            paper_id, file_url = await _save_generated(req, paper_text)
+        except Exception as e:
+            print(f"Generation Route Error: {e}")
+            yield json.dumps({"status": "error", "detail": str(e), "retryable": getattr(e, "retryable", False)}) + "\n"
+            return
+
+        yield json.dumps({
+            "status": "success",
+            "paper_id": paper_id,
+            "text": paper_text,
+            "url": file_url,
+            "bank": bank
+        }) + "\n"
+
+    return StreamingResponse(generate_generator(), media_type="application/x-ndjson")
+
+@app.get("/question-bank/search")
+async def question_bank_search_route(
+    q: str, board: Optional[str] = None, class_level: Optional[str] = None, subject: Optional[str] = None,
+    marks: Optional[float] = None, limit: int = 20
+):
+    """Full-text search over banked questions (generated papers) and worked answers (solved papers)."""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty search")
+    return await run_in_threadpool(question_bank.search, q, board, class_level, subject, marks, max(1, min(limit, 100)))
+
+@app.get("/question-bank/stats")
+async def question_bank_stats_route():
+    return question_bank.stats()
+
+def _etag_matches(request, etag):
+    """If-None-Match check: "*", or any listed entity tag equal to `etag` (weak comparison, so W/ is ignored)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in re.findall(r'(?:W/)?("[^"]*")', header)
+
+async def _list_response(request, fetch, limit, cursor, fields):
+    """
+    Serves one page of a list endpoint as a JSON array.
+    The cursor for the next page goes in X-Next-Cursor, and an ETag over the body
+    (rendered once per cached page) lets an unchanged page come back as 304 with no payload.
+    """
+    columns = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        page = await fetch(limit=limit, cursor=cursor, columns=columns)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    body, etag = page.render()
+    headers = {"ETag": etag}
+    if page.next_cursor:
+        headers["X-Next-Cursor"] = page.next_cursor
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
 @app.get("/generated-papers")
-async def get_generated_papers_route():
-    return get_generated_papers()
+async def get_generated_papers_route(
+    request: Request, limit: Optional[int] = None, cursor: Optional[str] = None, fields: Optional[str] = None
+):
+    return await _list_response(request, get_generated_papers, limit, cursor, fields)
+
+async def _pdf_response(request, fetch_markdown, filename):
+    """
+    Serves stored markdown as a PDF, rendered once per distinct text (see pdfs.py).
+    The ETag is the render key, so a client holding this version gets a 304.
+    """
+    try:
+        markdown = await fetch_markdown()
+    except Exception as e:
+        print(f"PDF Source Error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load the document")
+    if markdown is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    headers = {"ETag": f'"{pdf_cache_key(markdown)[:32]}"', "Content-Disposition": f'inline; filename="{filename}"'}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    try:
+        pdf = await markdown_to_pdf(markdown)
+    except PdfRenderError as e:
+        print(f"PDF Render Error: {e}")
+        raise HTTPException(status_code=503 if e.retryable else 500, detail=str(e))
+    return Response(pdf, media_type="application/pdf", headers=headers)
+
+@app.get("/generated-papers/{paper_id}/pdf")
+async def generated_paper_pdf_route(paper_id: str, request: Request):
+    return await _pdf_response(request, lambda: get_generated_paper_text(paper_id), f"paper-{paper_id}.pdf")
+
+# Local indexes are only cleared once the remote delete has succeeded, so a failed
+# (deferred) purge that brings the row back finds them intact.
+async def _purge_generated_paper(paper_id):
+    await delete_generated_paper(paper_id)
+    await run_in_threadpool(question_bank.delete_paper, paper_id)
 
 @app.delete("/generated-papers/{paper_id}")
-async def delete_generated_paper_route(paper_id: str):
+async def delete_generated_paper_route(paper_id: str, deferred: bool = DEFERRED_DELETES):
     try:
-        delete_generated_paper(paper_id)
+        if deferred:
+            defer_delete("generated_papers", paper_id, _purge_generated_paper(paper_id))
+            return {"status": "success", "deferred": True}
+        await _purge_generated_paper(paper_id)
         return {"status": "success"}
     except Exception as e:
         print(f"Delete Error: {e}")
         raise HTTPException(status_code=500, detail="Failed to delete generated paper")
 
+def _index_solution(paper_id, text):
+    """Re-indexes a saved solution for reference slicing and the question bank (SQLite + FTS5; run off the loop)."""
+    reference_store.save(paper_id, text)
+    question_bank.add_solved(paper_id, text)
+
 @app.put("/paper/{paper_id}/solution")
 async def update_solution_route(paper_id: str, update: SolutionUpdate):
+    """
+    Accepts the edit and returns its version; the file is written in the background once edits pause,
+    and the local indexes follow once it is. GET .../solution/status reports a write that failed.
+    """
+    async def index(text):
+        await run_in_threadpool(_index_solution, paper_id, text)
     try:
-        success = update_paper_solution(paper_id, update.text)
-        if not success:
-             raise HTTPException(status_code=404, detail="Paper not found")
-        return {"status": "success"}
+        version = await update_paper_solution(paper_id, update.text, on_saved=index)
     except Exception as e:
         print(f"Update Error: {e}")
         raise HTTPException(status_code=500, detail="Failed to update solution")
+    if version is None:
+        raise HTTPException(status_code=404, detail="Paper not found")
+    return {"status": "success", "version": version}
+
+async def _text_response(fetch_markdown):
+    """Serves stored markdown, including an edit not yet written to storage."""
+    try:
+        markdown = await fetch_markdown()
+    except Exception as e:
+        print(f"Document Load Error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load the document")
+    if markdown is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return Response(markdown, media_type="text/markdown")
+
+@app.get("/paper/{paper_id}/solution")
+async def solution_route(paper_id: str):
+    return await _text_response(lambda: get_paper_solution_text(paper_id))
+
+@app.get("/paper/{paper_id}/solution/pdf")
+async def solution_pdf_route(paper_id: str, request: Request):
+    """The solution as a PDF, including edits not yet written to storage."""
+    return await _pdf_response(request, lambda: get_paper_solution_text(paper_id), f"solution-{paper_id}.pdf")
+
+@app.get("/paper/{paper_id}/solution/status")
+async def solution_save_status_route(paper_id: str):
+    """Whether the latest accepted edit has been written (saved_version == version)."""
+    return edit_status("solutions", paper_id)
 
 @app.get("/history")
-async def get_history_route():
-    return get_records()
+async def get_history_route(
+    request: Request, limit: Optional[int] = None, cursor: Optional[str] = None, fields: Optional[str] = None
+):
+    return await _list_response(request, get_records, limit, cursor, fields)
+
+def _unindex_paper(paper_id):
+    reference_store.delete(paper_id)
+    question_bank.delete_paper(paper_id, "solved")
+    grade_store.delete_paper(paper_id)
+
+async def _purge_paper(paper_id):
+    await delete_paper_record(paper_id)
+    await run_in_threadpool(_unindex_paper, paper_id)
 
 @app.delete("/history/{paper_id}")
-async def delete_paper_route(paper_id: str):
+async def delete_paper_route(paper_id: str, deferred: bool = DEFERRED_DELETES):
     try:
-        delete_paper_record(paper_id)
+        if deferred:
+            defer_delete("solutions", paper_id, _purge_paper(paper_id))
+            return {"status": "success", "deferred": True}
+        await _purge_paper(paper_id)
         return {"status": "success"}
     except Exception as e:
         print(f"Delete Error: {e}")
         raise HTTPException(status_code=500, detail="Failed to delete paper")
 
+async def _spool_uploads(files):
+    """Spools UploadFiles to disk (see uploads.py), mapping a file over the size limit to 413."""
+    spooled = []
+    try:
+        for file in files:
+            spooled.append(await spool_upload(file))
+    except BaseException as e:
+        discard(spooled)
+        if isinstance(e, UploadLimitError):
+            raise _upload_error(e)
+        raise
+    return spooled
+
+async def _load_student_pages(script):
+    """Renders a spooled student PDF on the pool, or prepares a photo upload."""
+    if script["content_type"] == "application/pdf":
+        with span("evaluate.render"):
+            return await render_pdf(script["path"], script["page_count"])
+    # It's an image: only its (downscaled) payload is kept
+    return [await run_in_threadpool(prepare_image, script["path"])]
+
+async def _upload_or_blank(file_bytes, destination_path, content_type):
+    try:
+        return await upload_bytes_to_supabase(file_bytes, "papers", destination_path, content_type)
+    except Exception:
+        return ""
+
+async def _upload_file_or_blank(path, filename, content_type):
+    try:
+        return await upload_file_deduplicated(path, "papers", filename, content_type)
+    except Exception:
+        return ""
+
+async def _discard_unsaved(*file_urls):
+    """Removes files uploaded for a row that will not be saved, releasing their blob references."""
+    await asyncio.shield(delete_from_storage(*file_urls))
+
+async def _finish_submission(job_id, paper_id, student_name, submission_url, report_text):
+    """Scores a finished report and uploads it. Returns the submission row (not yet saved)."""
+    score = extract_score(report_text)
+    report_url = await _upload_or_blank(report_text.encode('utf-8'), f"evaluations/{job_id}.md", "text/markdown")
+    return {
+        "paper_id": paper_id,
+        "student_name": student_name,
+        "score": score,
+        "submission_url": submission_url,
+        "report_url": report_url
+    }
+
+async def _reference_text(paper_id, reference_solution=None, questions=None):
+    """
+    Reference solution for grading: the posted text if any, otherwise the stored index for paper_id
+    (built from the stored solution file on first use). Sliced to `questions` (e.g. "1-5,8") when given.
+    Raises ValueError for a bad selection and LookupError when the paper has no solution.
+    """
+    wanted = parse_question_selection(questions)
+    if reference_solution and wanted is None:
+        return reference_solution
+
+    if reference_solution:
+        indexed = parse_solution(reference_solution)
+    else:
+        indexed = reference_store.get(paper_id)
+        if indexed is None:
+            markdown = await get_paper_solution_text(paper_id)
+            if markdown is None:
+                raise LookupError("Reference solution not found")
+            reference_store.save(paper_id, markdown)
+            indexed = reference_store.get(paper_id)
+
+    if not any(q["number"] for q in indexed):
+        # No question headers to slice by; grade against the whole text
+        return reference_solution or render_reference(indexed)
+    text = render_reference(indexed, wanted)
+    if not text:
+        raise ValueError("None of the selected questions are in the reference solution")
+    return text
+
+async def _load_reference(paper_id, reference_solution, questions):
+    """_reference_text with its errors mapped to HTTP responses."""
+    try:
+        return await _reference_text(paper_id, reference_solution, questions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+async def _record_grades(saved_rows, reports):
+    """
+    Stores per-question marks for freshly inserted submissions. Returns the first one's marks.
+    One SQLite transaction and one analytics rebuild per paper, run in the threadpool.
+    """
+    recorded = await run_in_threadpool(grade_store.record_many, [
+        (saved["id"], saved["paper_id"], saved["score"], report_text) for saved, report_text in zip(saved_rows, reports)
+    ])
+    return next((marks for marks in recorded if marks), [])
+
+async def _grade_submission(paper_id, student_name, script, reference_solution, queue_timeout=UPLOAD_QUEUE_SECONDS):
+    """
+    Grades one spooled script and uploads its files; the spooled file is removed afterwards.
+    Waits up to `queue_timeout` for memory to hold its pages (UploadLimitError after that).
+    Returns the submission row (not yet saved) and the report.
+    """
+    job_id = str(uuid.uuid4())
+    try:
+        await count_pages([script])
+        async with upload_memory.reserve(estimate_memory([script]), queue_timeout):
+            try:
+                processed_images = await _load_student_pages(script)
+            except Exception as e:
+                print(f"Error converting Student PDF: {e}")
+                raise ValueError(f"Invalid PDF: {e}")
+
+            # Pass list of images to solver
+            with span("evaluate.grade"):
+                report_text = await run_in_threadpool(evaluate_student_solution, processed_images, reference_solution)
+        # Uploaded once graded, so a failed grading leaves no stored copy (or blob reference) behind
+        submission_url = await _upload_file_or_blank(script["path"], script["filename"], script["content_type"])
+    finally:
+        discard([script])
+    try:
+        row = await _finish_submission(job_id, paper_id, student_name, submission_url, report_text)
+    except BaseException:
+        await _discard_unsaved(submission_url)
+        raise
+    return row, report_text
+
 @app.post("/evaluate")
 async def evaluate_paper(
     paper_id: str = Form(...), 
     student_file: UploadFile = File(...),
     student_name: str = Form(...),
-    reference_solution: str = Form(...)
+    reference_solution: Optional[str] = Form(None),
+    questions: Optional[str] = Form(None)
 ):
     print(f"Evaluating {student_name}")
-    job_id = str(uuid.uuid4())
-    
-    file_bytes = await student_file.read()
-    
-    # --- ADDED: Process PDF for evaluation ---
-    processed_images = []
-    
-    if student_file.content_type == "application/pdf":
-        try:
-            pdf = pdfium.PdfDocument(file_bytes)
-            for page in pdf:
-                bitmap = page.render(scale=2) 
-                pil_image = bitmap.to_pil()
-                processed_images.append(pil_image)
-        except Exception as e:
-            print(f"Error converting Student PDF: {e}")
-            raise HTTPException(status_code=400, detail=f"Invalid PDF: {e}")
-    else:
-        # It's an image
-        processed_images.append(io.BytesIO(file_bytes))
+    reference_solution = await _load_reference(paper_id, reference_solution, questions)
+    script = (await _spool_uploads([student_file]))[0]
 
     try:
-        submission_url = upload_bytes_to_supabase(
-            file_bytes, "papers", f"students/{job_id}_{student_file.filename}", student_file.content_type
-        )
-    except Exception:
-        submission_url = ""
-
-    # Pass list of images to solver
-    report_text = evaluate_student_solution(processed_images, reference_solution)
-    score = extract_score(report_text)
+        row, report_text = await _grade_submission(paper_id, student_name, script, reference_solution)
+    except UploadLimitError as e:
+        raise _upload_error(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ModelCallError as e:
+        raise HTTPException(status_code=_model_error_status(e), detail=f"Evaluation failed: {e}")
 
     try:
-        report_url = upload_bytes_to_supabase(
-            report_text.encode('utf-8'), "papers", f"evaluations/{job_id}.md", "text/markdown"
-        )
-    except Exception:
-        report_url = ""
+        saved = await save_student_submission(**row)
+    except BaseException:
+        await _discard_unsaved(row["submission_url"], row["report_url"])
+        raise
+    marks = await _record_grades(saved, [report_text])
 
-    save_student_submission(paper_id, student_name, score, submission_url, report_url)
-    
     return {
         "student_name": student_name,
-        "score": score,
+        "score": row["score"],
+        "question_marks": marks,
         "evaluation_report": report_text
     }
 
+def _expand_batch_files(uploads):
+    """
+    Flattens spooled scripts and zip archives into (student_name, script) pairs.
+    Zip entries are streamed out to spooled files of their own and the archives removed. Unpacked entries
+    count towards UPLOAD_MAX_FILES and UPLOAD_MAX_REQUEST_BYTES like uploaded files, so a zip bomb stops there.
+    """
+    scripts = []
+    total_files, total_bytes = 0, 0
+    too_large = f"Unpacked uploads exceed {format_size(UPLOAD_MAX_REQUEST_BYTES)}"
+
+    def count_file():
+        nonlocal total_files
+        total_files += 1
+        if total_files > UPLOAD_MAX_FILES:
+            raise UploadLimitError(f"More than {UPLOAD_MAX_FILES} files in one request")
+
+    try:
+        for upload in uploads:
+            filename, content_type = upload["filename"], upload["content_type"]
+            if content_type in ("application/zip", "application/x-zip-compressed") or filename.lower().endswith(".zip"):
+                with zipfile.ZipFile(upload["path"]) as archive:
+                    for entry in archive.infolist():
+                        entry_name = os.path.basename(entry.filename)
+                        if entry.is_dir() or not entry_name or entry_name.startswith("."):
+                            continue
+                        entry_type = mimetypes.guess_type(entry_name)[0]
+                        if entry_type != "application/pdf" and not (entry_type or "").startswith("image/"):
+                            continue
+                        count_file()
+                        max_bytes = min(UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_REQUEST_BYTES - total_bytes)
+                        with archive.open(entry) as source:
+                            script = spool_file(
+                                source, entry_name, entry_type,
+                                max_bytes, too_large if max_bytes < UPLOAD_MAX_FILE_BYTES else None,
+                            )
+                        scripts.append((os.path.splitext(entry_name)[0], script))
+                        total_bytes += script["size"]
+                discard([upload])
+            else:
+                count_file()
+                total_bytes += upload["size"]
+                if total_bytes > UPLOAD_MAX_REQUEST_BYTES:
+                    raise UploadLimitError(too_large)
+                scripts.append((os.path.splitext(filename)[0], upload))
+    except BaseException:
+        discard(uploads)
+        discard([script for _, script in scripts])
+        raise
+    return scripts
+
+async def _save_batch_rows(graded):
+    """
+    Inserts [(student_name, row, report_text)] in one request (retried) and records their grades.
+    Returns one event per student.
+    """
+    for attempt in range(1, EVAL_BATCH_SAVE_ATTEMPTS + 1):
+        try:
+            saved = await save_student_submissions([row for _, row, _ in graded])
+            break
+        except Exception as e:
+            print(f"Batch save failed (attempt {attempt}): {e}")
+            if attempt == EVAL_BATCH_SAVE_ATTEMPTS:
+                await _discard_unsaved(*(url for _, row, _ in graded for url in (row["submission_url"], row["report_url"])))
+                return [
+                    {"status": "failed", "student_name": student_name, "error": f"Could not save the result: {e}"}
+                    for student_name, _, _ in graded
+                ]
+            await asyncio.sleep(attempt)
+    await _record_grades(saved, [report_text for _, _, report_text in graded])
+    return [
+        {
+            "status": "graded",
+            "student_name": student_name,
+            "submission_id": row["id"],
+            "score": row["score"],
+            "evaluation_report": report_text
+        }
+        for (student_name, _, report_text), row in zip(graded, saved)
+    ]
+
+async def _run_batch(paper_id, scripts, reference_solution, events):
+    """
+    Grades (student_name, script) pairs EVAL_BATCH_CONCURRENCY at a time and puts progress events on
+    `events`, ending with None. Results are saved every EVAL_BATCH_SAVE_ROWS students or
+    EVAL_BATCH_SAVE_SECONDS, and a student's "graded" event is only sent once its row is saved.
+    """
+    semaphore = asyncio.Semaphore(EVAL_BATCH_CONCURRENCY)
+
+    async def grade(student_name, script):
+        async with semaphore:
+            try:
+                # Scripts of a batch queue for memory instead of failing
+                row, report_text = await _grade_submission(
+                    paper_id, student_name, script, reference_solution, queue_timeout=None
+                )
+                return student_name, row, report_text, None
+            except Exception as e:
+                print(f"Batch Evaluation Error ({student_name}): {e}")
+                return student_name, None, None, str(e)
+
+    total = len(scripts)
+    counts = {"graded": 0, "failed": 0}
+
+    def emit(batch_events):
+        for event in batch_events:
+            counts[event["status"]] += 1
+            event.update({"current": counts["graded"] + counts["failed"], "total": total})
+            events.put_nowait(event)
+
+    pending = {asyncio.create_task(grade(student_name, script)) for student_name, script in scripts}
+    graded = []     # graded, not yet saved
+    oldest = None   # when the first of them finished
+    try:
+        while pending:
+            timeout = None if oldest is None else max(0, oldest + EVAL_BATCH_SAVE_SECONDS - time.monotonic())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                student_name, row, report_text, error = task.result()
+                if error:
+                    emit([{"status": "failed", "student_name": student_name, "error": error}])
+                else:
+                    graded.append((student_name, row, report_text))
+                    oldest = oldest or time.monotonic()
+            if graded and (len(graded) >= EVAL_BATCH_SAVE_ROWS or time.monotonic() - oldest >= EVAL_BATCH_SAVE_SECONDS):
+                batch, graded, oldest = graded, [], None
+                emit(await _save_batch_rows(batch))
+    finally:
+        # Also on shutdown: whatever was graded is still saved
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Lets cancelled gradings release what they uploaded
+            await asyncio.wait(pending)
+        discard([script for _, script in scripts])
+        if graded:
+            emit(await _save_batch_rows(graded))
+        events.put_nowait({
+            "status": "completed",
+            "paper_id": paper_id,
+            "graded": counts["graded"],
+            "failed": total - counts["graded"]
+        })
+        events.put_nowait(None)
+
+@app.post("/evaluate/batch")
+async def evaluate_batch(
+    paper_id: str = Form(...),
+    student_files: List[UploadFile] = File(...),
+    reference_solution: Optional[str] = Form(None),
+    questions: Optional[str] = Form(None)
+):
+    """Grades a whole class. Each file (or zip entry) is one student, named after the file."""
+    reference_solution = await _load_reference(paper_id, reference_solution, questions)
+    uploads = await _spool_uploads(student_files)
+    try:
+        scripts = await asyncio.to_thread(_expand_batch_files, uploads)
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid zip: {e}")
+    except UploadLimitError as e:
+        raise _upload_error(e)
+    if not scripts:
+        raise HTTPException(status_code=400, detail="No student scripts found.")
+    print(f"Batch evaluating {len(scripts)} script(s) for paper {paper_id}")
+
+    # Graded and saved in the background, so a client going away does not lose the class
+    events = asyncio.Queue()
+    task = asyncio.create_task(_run_batch(paper_id, scripts, reference_solution, events))
+    _batches.add(task)
+    task.add_done_callback(_batches.discard)
+
+    async def batch_generator():
+        while (event := await events.get()) is not None:
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(batch_generator(), media_type="application/x-ndjson")
+
+@app.post("/evaluate/stream")
+async def evaluate_paper_stream(
+    paper_id: str = Form(...),
+    student_file: UploadFile = File(...),
+    student_name: str = Form(...),
+    reference_solution: Optional[str] = Form(None),
+    questions: Optional[str] = Form(None)
+):
+    """Like /evaluate, but streams the report as NDJSON chunks while the model writes it."""
+    print(f"Evaluating {student_name} (streaming)")
+    reference_solution = await _load_reference(paper_id, reference_solution, questions)
+    job_id = str(uuid.uuid4())
+    script = (await _spool_uploads([student_file]))[0]
+
+    try:
+        await count_pages([script])
+        reserved = estimate_memory([script])
+        await upload_memory.acquire(reserved)
+    except UploadLimitError as e:
+        discard([script])
+        raise _upload_error(e)
+
+    try:
+        processed_images = await _load_student_pages(script)
+    except Exception as e:
+        await upload_memory.release(reserved)
+        discard([script])
+        print(f"Error converting Student PDF: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid PDF: {e}")
+
+    # The original upload overlaps with grading; the spooled file goes once it is sent
+    submission_upload = asyncio.create_task(_upload_file_or_blank(script["path"], script["filename"], script["content_type"]))
+    submission_upload.add_done_callback(lambda _: discard([script]))
+
+    released = False
+
+    async def release_pages():
+        # The pages are not needed once the report is written
+        nonlocal released
+        if not released:
+            released = True
+            processed_images.clear()
+            await upload_memory.release(reserved)
+
+    settled = False  # the original's upload belongs to a saved row, or was removed
+
+    async def drop_submission(*file_urls):
+        # A finished upload already holds a blob reference, which no row will take over
+        nonlocal settled
+        if settled:
+            return
+        settled = True
+        submission_upload.cancel()
+        await asyncio.wait([submission_upload])
+        if not submission_upload.cancelled():
+            file_urls = (submission_upload.result(), *file_urls)
+        await _discard_unsaved(*file_urls)
+
+    async def abandon():
+        # Response background task: covers a stream that never started or was cut off by a disconnect
+        await drop_submission()
+        await release_pages()
+
+    async def evaluate_generator():
+        nonlocal settled
+        report_text = ""
+        try:
+            async for chunk in iterate_in_threadpool(
+                evaluate_student_solution_stream(processed_images, reference_solution)
+            ):
+                report_text += chunk
+                yield json.dumps({"status": "chunk", "text": chunk}) + "\n"
+        except Exception as e:
+            print(f"Evaluation Error: {e}")
+            await drop_submission()
+            yield json.dumps({"status": "error", "detail": str(e), "retryable": getattr(e, "retryable", False)}) + "\n"
+            return
+        finally:
+            await release_pages()
+
+        # Persist only once the full report has arrived
+        row = {}
+        try:
+            submission_url = await submission_upload
+            row = await _finish_submission(job_id, paper_id, student_name, submission_url, report_text)
+            saved = await save_student_submission(**row)
+        except Exception as e:
+            print(f"Evaluation Save Error: {e}")
+            await drop_submission(row.get("report_url"))
+            yield json.dumps({"status": "error", "detail": f"Could not save the result: {e}", "retryable": True}) + "\n"
+            return
+        settled = True
+        marks = await _record_grades(saved, [report_text])
+
+        yield json.dumps({
+            "status": "completed",
+            "student_name": student_name,
+            "score": row["score"],
+            "question_marks": marks,
+            "evaluation_report": report_text
+        }) + "\n"
+
+    return StreamingResponse(evaluate_generator(), media_type="application/x-ndjson", background=BackgroundTask(abandon))
+
 @app.put("/student/{student_id}")
 async def update_student_grade_route(student_id: str, update: GradeUpdate):
+    """Accepts the new grade and returns its version; the row and report are written in the background."""
     try:
-        update_student_submission(student_id, update.score, update.report)
-        return {"status": "success"}
+        accepted = await update_student_submission(student_id, update.score, update.report)
     except Exception as e:
         print(f"Grade Update Error: {e}")
         raise HTTPException(status_code=500, detail="Failed to update grade")
+    if accepted is None:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    version, paper_id = accepted
+    await run_in_threadpool(grade_store.record, student_id, paper_id, update.score, update.report)
+    return {"status": "success", "version": version}
+
+@app.get("/student/{student_id}/report")
+async def report_route(student_id: str):
+    return await _text_response(lambda: get_student_report_text(student_id))
+
+@app.get("/student/{student_id}/report/pdf")
+async def report_pdf_route(student_id: str, request: Request):
+    return await _pdf_response(request, lambda: get_student_report_text(student_id), f"report-{student_id}.pdf")
+
+@app.get("/student/{student_id}/status")
+async def grade_save_status_route(student_id: str):
+    """Whether the latest accepted grade edit has been written (saved_version == version)."""
+    return edit_status("student_submissions", student_id)
 
 @app.get("/paper/{paper_id}/students")
-async def get_paper_students(paper_id: str):
-    return get_student_submissions(paper_id)
+async def get_paper_students(
+    paper_id: str, request: Request,
+    limit: Optional[int] = None, cursor: Optional[str] = None, fields: Optional[str] = None
+):
+    async def fetch(**page):
+        return await get_student_submissions(paper_id, **page)
+    return await _list_response(request, fetch, limit, cursor, fields)
+
+@app.get("/paper/{paper_id}/analytics")
+async def get_paper_analytics(paper_id: str):
+    """Class averages, score distribution and per-question difficulty, precomputed on every grade write."""
+    analytics = grade_store.get_analytics(paper_id)
+    if analytics is None:
+        analytics = {**compute_paper_analytics([], []), "paper_id": paper_id, "updated_at": None}
+    return analytics
+
+async def _purge_student(student_id):
+    await delete_student_record(student_id)
+    await run_in_threadpool(grade_store.delete_submission, student_id)
 
 @app.delete("/student/{student_id}")
-async def delete_student_route(student_id: str):
+async def delete_student_route(student_id: str, deferred: bool = DEFERRED_DELETES):
     try:
-        delete_student_record(student_id)
+        if deferred:
+            defer_delete("student_submissions", student_id, _purge_student(student_id))
+            return {"status": "success", "deferred": True}
+        await _purge_student(student_id)
         return {"status": "success"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Failed to delete student submission")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to delete student submission")
+
+@app.get("/model/stats")
+async def model_stats_route():
+    return model_call_stats()
+
+@app.get("/metrics")
+async def metrics_route():
+    """Prometheus scrape endpoint."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/cache/stats")
+async def cache_stats_route():
+    return {
+        "solutions": solution_cache.stats(), "reads": read_cache.stats(), "storage": blob_index.stats(),
+        "pdfs": pdf_cache.stats()
+    }
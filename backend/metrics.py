@@ -0,0 +1,108 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Prometheus series for every pipeline stage, scraped from GET /metrics.
+# Labels are kept low-cardinality: stage names and model call kinds, never ids or page numbers.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "teacher_assistant_stage_seconds", "Time spent in one pipeline stage", ["stage"], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "teacher_assistant_http_request_seconds", "HTTP request latency until the response starts",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+MODEL_CALL_SECONDS = Histogram(
+    "teacher_assistant_model_call_seconds", "Latency of single Gemini requests", ["kind", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+MODEL_CALLS = Counter("teacher_assistant_model_calls_total", "Gemini requests by outcome", ["kind", "outcome"])
+MODEL_TOKENS = Counter("teacher_assistant_model_tokens_total", "Gemini tokens from usage metadata", ["kind", "type"])
+MODEL_QUEUE_DEPTH = Gauge("teacher_assistant_model_queue_depth", "Model requests waiting for the scheduler", ["kind"])
+MODEL_QUEUE_WAIT_SECONDS = Histogram(
+    "teacher_assistant_model_queue_wait_seconds", "Time a model request waited for the scheduler", ["kind"],
+    buckets=LATENCY_BUCKETS
+)
+MODEL_IN_FLIGHT = Gauge("teacher_assistant_model_in_flight", "Model requests admitted by the scheduler and not yet finished")
+UPLOAD_RESERVED_BYTES = Gauge("teacher_assistant_upload_reserved_bytes", "Memory reserved by requests holding rendered pages")
+UPLOAD_REJECTIONS = Counter("teacher_assistant_upload_rejections_total", "Uploads refused by a limit", ["reason"])
+
+# Per-request (or per-job) timing totals, for the optional trailer on final NDJSON events
+_timings = contextvars.ContextVar("timings", default=None)
+
+class Timings:
+    """Accumulates stage -> (count, seconds) across the threads working on one request."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            count, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds)
+
+    def add_tokens(self, token_type, count):
+        with self.lock:
+            self.tokens[token_type] = self.tokens.get(token_type, 0) + count
+
+    def summary(self):
+        with self.lock:
+            stages = {
+                stage: {"count": count, "seconds": round(total, 4)} for stage, (count, total) in sorted(self.stages.items())
+            }
+            tokens = dict(self.tokens)
+        return {"wall_seconds": round(time.monotonic() - self.started, 4), "stages": stages, "tokens": tokens}
+
+def start_timings():
+    """Starts collecting span totals for the current context. Returns the Timings."""
+    timings = Timings()
+    _timings.set(timings)
+    return timings
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+@contextmanager
+def span(stage):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(stage, time.monotonic() - started)
+
+def model_kind(label):
+    """'solve page 3' -> 'solve', 'evaluate (stream)' -> 'evaluate'."""
+    return label.split()[0] if label else "unknown"
+
+def record_model_call(label, seconds, outcome):
+    kind = model_kind(label)
+    MODEL_CALL_SECONDS.labels(kind, outcome).observe(seconds)
+    MODEL_CALLS.labels(kind, outcome).inc()
+    observe(f"model.{kind}", seconds)
+
+def record_usage(label, response):
+    """Counts tokens from a Gemini response's usage_metadata. Returns the response unchanged."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        kind = model_kind(label)
+        timings = _timings.get()
+        for token_type, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+            count = getattr(usage, field, 0) or 0
+            if count:
+                MODEL_TOKENS.labels(kind, token_type).inc(count)
+                if timings is not None:
+                    timings.add_tokens(token_type, count)
+    return response
+
+def render_metrics():
+    """(body, content_type) for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
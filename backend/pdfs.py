@@ -0,0 +1,129 @@
+import os
+import re
+import shutil
+import asyncio
+import hashlib
+import tempfile
+from cache import pdf_cache
+from metrics import span
+
+# Printable PDFs of generated papers, solutions and evaluation reports.
+# Markdown (with LaTeX math and the bit of HTML the paper prompts emit) goes through pandoc and a
+# LaTeX engine, which must be installed on the host. Renders are cached by a hash of the markdown
+# and TEMPLATE_VERSION, so unchanged text is never typeset twice.
+PANDOC_PATH = os.getenv("PANDOC_PATH", "pandoc")
+PDF_ENGINE = os.getenv("PDF_ENGINE", "xelatex")
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))    # concurrent pandoc/LaTeX processes
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "120"))
+
+# Bump whenever the filter, the pandoc options or _to_pandoc_markdown change the output
+TEMPLATE_VERSION = "1"
+
+PANDOC_ARGS = [
+    "--from=markdown",  # $math$, raw LaTeX and pipe tables; leftover HTML is dropped
+    "-V", "geometry:a4paper,margin=2cm",
+    "-V", "fontsize=11pt",
+    "-V", "colorlinks=true",
+]
+
+# Turns the ::: center divs produced by _to_pandoc_markdown into a LaTeX center environment
+LUA_FILTER = r"""
+function Div(el)
+  if el.classes:includes("center") then
+    local blocks = {pandoc.RawBlock("latex", "\\begin{center}")}
+    for _, block in ipairs(el.content) do table.insert(blocks, block) end
+    table.insert(blocks, pandoc.RawBlock("latex", "\\end{center}"))
+    return blocks
+  end
+end
+"""
+
+class PdfRenderError(Exception):
+    """A failed render. `retryable` when the renderer is missing, busy or timed out rather than the text being bad."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+# --- MARKDOWN PREPARATION ---
+HEADINGS = {"h1": r"\LARGE", "h2": r"\Large", "h3": r"\large", "h4": r"\normalsize"}
+
+def _heading(match):
+    return f"\\textbf{{{HEADINGS[match.group(1).lower()]} {match.group(2).strip()}}}\n"
+
+def _spread(match):
+    # <div style="display: flex; justify-content: space-between"> -> items pushed to both margins
+    items = [line.strip() for line in match.group(1).splitlines() if line.strip()]
+    return "\n\n" + r" \hfill ".join(items) + "\n\n"
+
+def _to_pandoc_markdown(markdown):
+    """Rewrites the HTML used by the paper prompts into markdown and inline LaTeX pandoc can typeset."""
+    text = re.sub(r"<div[^>]*space-between[^>]*>(.*?)</div>", _spread, markdown, flags=re.S | re.I)
+    text = re.sub(r"<center>\s*", "\n\n::: center\n", text, flags=re.I)
+    text = re.sub(r"\s*</center>", "\n:::\n\n", text, flags=re.I)
+    text = re.sub(r"<(h[1-4])[^>]*>(.*?)</\1>", _heading, text, flags=re.S | re.I)
+    text = re.sub(r"<b>(.*?)</b>", r"**\1**", text, flags=re.S | re.I)
+    text = re.sub(r"<i>(.*?)</i>", r"*\1*", text, flags=re.S | re.I)
+    text = re.sub(r"(?:\s*<br\s*/?>)+", "\n\n\\\\medskip\n\n", text, flags=re.I)
+    text = re.sub(r"<hr\s*/?>", "\n\n---\n\n", text, flags=re.I)
+    return re.sub(r"</?div[^>]*>", "", text, flags=re.I)
+
+def pdf_cache_key(markdown):
+    return hashlib.sha256(f"{TEMPLATE_VERSION}\0{PDF_ENGINE}\0{markdown}".encode("utf-8")).hexdigest()
+
+# --- RENDERING ---
+_render_slots: asyncio.Semaphore = None
+_pending_renders = {}  # cache key -> render task, so a class downloading at once typesets the text once
+
+async def _run_pandoc(markdown):
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(PDF_RENDER_WORKERS)
+    async with _render_slots:
+        workdir = tempfile.mkdtemp(prefix="ta-pdf-")
+        try:
+            with open(os.path.join(workdir, "filter.lua"), "w") as f:
+                f.write(LUA_FILTER)
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    PANDOC_PATH, *PANDOC_ARGS, f"--pdf-engine={PDF_ENGINE}", "--lua-filter=filter.lua",
+                    "-o", "out.pdf",
+                    cwd=workdir, stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+            except FileNotFoundError:
+                raise PdfRenderError(f"PDF rendering is unavailable: {PANDOC_PATH} is not installed", True)
+            try:
+                _, stderr = await asyncio.wait_for(
+                    process.communicate(_to_pandoc_markdown(markdown).encode("utf-8")), PDF_RENDER_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise PdfRenderError(f"PDF rendering timed out after {PDF_RENDER_TIMEOUT:.0f}s", True)
+            if process.returncode != 0:
+                raise PdfRenderError(f"PDF rendering failed: {stderr.decode('utf-8', 'replace').strip()[-500:]}")
+            with open(os.path.join(workdir, "out.pdf"), "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+async def _render(key, markdown):
+    with span("pdf.render"):
+        pdf = await _run_pandoc(markdown)
+    await asyncio.to_thread(pdf_cache.set, key, pdf)
+    return pdf
+
+async def markdown_to_pdf(markdown):
+    """PDF bytes for the markdown, from the cache when this text was rendered before. Raises PdfRenderError."""
+    key = pdf_cache_key(markdown)
+    with span("pdf.cache_lookup"):
+        cached = await asyncio.to_thread(pdf_cache.get, key)
+    if cached is not None:
+        return cached
+    task = _pending_renders.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_render(key, markdown))
+        _pending_renders[key] = task
+        task.add_done_callback(lambda _: _pending_renders.pop(key, None))
+    return await asyncio.shield(task)
@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import time
+import hashlib
+from cache import DATA_DIR, Lazy, open_store
+from references import parse_solution
+
+# Questions cut out of generated and solved papers, tagged by board/class/subject/chapters/marks and
+# full-text indexed (FTS5). A "bank" paper request reuses the layout of an earlier generated paper
+# and fills its slots from here, asking the model only for the questions the bank cannot supply.
+QUESTION_BANK_DB_PATH = os.path.join(DATA_DIR, "questionbank.sqlite3")
+BANK_MIN_COVERAGE = float(os.getenv("BANK_MIN_COVERAGE", "0.5"))          # below this share of slots, write the whole paper
+BANK_DIFFICULTY_TOLERANCE = int(os.getenv("BANK_DIFFICULTY_TOLERANCE", "20"))
+
+# --- PARSING ---
+SECTION_HEADER = re.compile(
+    r"^[^\n]*<h2[^>]*>\s*(SECTION\b[^<]*?)\s*</h2>[^\n]*$|^#{1,3}[ \t]*(SECTION\b[^\n]*?)[ \t]*$",
+    re.MULTILINE | re.IGNORECASE
+)
+QUESTION_START = re.compile(r"^[ \t]*(?:\*\*)?(Q\.?[ \t]*)?(\d{1,2})[.)](?:\*\*)?[ \t]+", re.MULTILINE)
+QUESTION_MARKS = re.compile(r"[\[(]\s*(\d+(?:\.\d+)?)\s*marks?\s*[\])]", re.IGNORECASE)
+SECTION_MARKS = re.compile(r"(\d+(?:\.\d+)?)\s*marks?\s+each", re.IGNORECASE)
+TRAILING_BREAKS = re.compile(r"(?:\s*<br\s*/?>)+\s*$", re.IGNORECASE)
+
+def _number(value):
+    return float(value) if value is not None else None
+
+def parse_paper(markdown):
+    """
+    Splits a generated paper into its header and sections. Returns
+    (header, [{"title", "heading", "questions": [{"marks", "text"}]}], numbering), where `heading` is the
+    section's own markup (title and note) and question text has its number stripped. Questions are only
+    recognised inside sections, so the numbered general instructions stay in the header.
+    """
+    markdown = markdown or ""
+    headers = list(SECTION_HEADER.finditer(markdown))
+    if not headers:
+        return markdown, [], ""
+
+    # A section starts at the spacing <br>s above its title
+    bounds = []
+    for header in headers:
+        spacing = TRAILING_BREAKS.search(markdown, 0, header.start())
+        bounds.append(spacing.start() if spacing else header.start())
+    bounds.append(len(markdown))
+
+    numbering = ""
+    sections = []
+    for i, header in enumerate(headers):
+        body = markdown[bounds[i]:bounds[i + 1]]
+        starts = list(QUESTION_START.finditer(body, header.end() - bounds[i]))
+        heading = TRAILING_BREAKS.sub("", body[:starts[0].start()] if starts else body).strip()
+        default = SECTION_MARKS.search(heading)
+        questions = []
+        for j, start in enumerate(starts):
+            numbering = numbering or ("Q" if start.group(1) else "")
+            text = body[start.end():starts[j + 1].start() if j + 1 < len(starts) else len(body)]
+            text = TRAILING_BREAKS.sub("", text.strip()).strip()
+            if not text:
+                continue
+            marks = QUESTION_MARKS.search(text)
+            questions.append({
+                "marks": _number(marks.group(1) if marks else default.group(1) if default else None),
+                "text": text,
+            })
+        title = " ".join((header.group(1) or header.group(2)).split()).upper()
+        sections.append({"title": title, "heading": heading, "questions": questions})
+    return markdown[:bounds[0]].rstrip(), sections, numbering
+
+def render_paper(header, sections, numbering=""):
+    """Inverse of parse_paper: numbers the questions 1..n continuously under their section headings."""
+    parts = [header]
+    number = 0
+    for section in sections:
+        parts.append(section["heading"])
+        for question in section["questions"]:
+            number += 1
+            parts.append(f"**{numbering}{number}.** {question['text']}")
+    return "\n\n\n".join(part for part in parts if part) + "\n"
+
+def _digest(text):
+    return hashlib.sha256(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+def _fts_query(query):
+    """Free text -> FTS5 query matching every word, with FTS syntax characters taken literally."""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in (query or "").split())
+
+# --- STORE ---
+class QuestionBank:
+    """SQLite question bank with an FTS5 index over question text and chapters."""
+
+    def __init__(self, path):
+        self.lock, self.conn = open_store(path, """
+            CREATE TABLE IF NOT EXISTS bank_papers (
+                source TEXT NOT NULL,
+                paper_id TEXT NOT NULL,
+                board TEXT,
+                class_level TEXT,
+                subject TEXT,
+                chapters TEXT NOT NULL,
+                difficulty INTEGER,
+                layout TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (source, paper_id)
+            );
+            CREATE INDEX IF NOT EXISTS bank_papers_by_tags ON bank_papers (board, class_level, subject, created_at);
+            CREATE TABLE IF NOT EXISTS bank_questions (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                paper_id TEXT NOT NULL,
+                board TEXT,
+                class_level TEXT,
+                subject TEXT,
+                chapters TEXT NOT NULL,
+                difficulty INTEGER,
+                section TEXT,
+                marks REAL,
+                text TEXT NOT NULL,
+                digest TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bank_questions_by_slot ON bank_questions (board, class_level, subject, section, marks);
+            CREATE INDEX IF NOT EXISTS bank_questions_by_paper ON bank_questions (source, paper_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS bank_search USING fts5(
+                text, chapters, content='bank_questions', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS bank_questions_insert AFTER INSERT ON bank_questions BEGIN
+                INSERT INTO bank_search (rowid, text, chapters) VALUES (new.id, new.text, new.chapters);
+            END;
+            CREATE TRIGGER IF NOT EXISTS bank_questions_delete AFTER DELETE ON bank_questions BEGIN
+                INSERT INTO bank_search (bank_search, rowid, text, chapters) VALUES ('delete', old.id, old.text, old.chapters);
+            END;
+        """)
+
+    def _replace(self, source, paper_id, tags, layout, questions):
+        """questions: [(section, marks, text)]. Runs under the lock."""
+        paper_id = str(paper_id)
+        chapters = json.dumps(tags.get("chapters") or [])
+        row = (tags.get("board"), tags.get("class_level"), tags.get("subject"), chapters, tags.get("difficulty"))
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM bank_questions WHERE source = ? AND paper_id = ?", (source, paper_id))
+            self.conn.executemany(
+                "INSERT INTO bank_questions (source, paper_id, board, class_level, subject, chapters, difficulty, "
+                "section, marks, text, digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(source, paper_id, *row, section, marks, text, _digest(text)) for section, marks, text in questions]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO bank_papers (source, paper_id, board, class_level, subject, chapters, difficulty, "
+                "layout, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, paper_id, *row, json.dumps(layout) if layout else None, time.time())
+            )
+        return len(questions)
+
+    def add_generated(self, paper_id, markdown, board, class_level, subject, chapters, difficulty):
+        """(Re)indexes a generated paper and keeps its layout for assembling later papers. Returns the question count."""
+        header, sections, numbering = parse_paper(markdown)
+        questions = [(s["title"], q["marks"], q["text"]) for s in sections for q in s["questions"]]
+        layout = None
+        if questions:
+            layout = {
+                "header": header,
+                "numbering": numbering,
+                "sections": [
+                    {"title": s["title"], "heading": s["heading"], "marks": [q["marks"] for q in s["questions"]]}
+                    for s in sections
+                ],
+            }
+        tags = {"board": board, "class_level": class_level, "subject": subject, "chapters": chapters, "difficulty": difficulty}
+        with self.lock:
+            return self._replace("generated", paper_id, tags, layout, questions)
+
+    def add_solved(self, paper_id, markdown):
+        """
+        (Re)indexes a solved paper's worked answers for search. Solutions carry no board/class tags and no
+        question statements, so they are never used to assemble a paper.
+        """
+        questions = [(None, _number(q["marks"]), q["text"]) for q in parse_solution(markdown) if q["number"]]
+        with self.lock:
+            return self._replace("solved", paper_id, {}, None, questions)
+
+    def delete_paper(self, paper_id, source="generated"):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM bank_questions WHERE source = ? AND paper_id = ?", (source, str(paper_id)))
+            self.conn.execute("DELETE FROM bank_papers WHERE source = ? AND paper_id = ?", (source, str(paper_id)))
+
+    def template(self, board, class_level, subject):
+        """(paper_id, layout) of the latest generated paper for these tags, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT paper_id, layout FROM bank_papers WHERE source = 'generated' AND board = ? AND class_level = ? "
+                "AND subject = ? AND layout IS NOT NULL ORDER BY created_at DESC LIMIT 1",
+                (board, class_level, subject)
+            ).fetchone()
+        return (row["paper_id"], json.loads(row["layout"])) if row else None
+
+    def pick(self, board, class_level, subject, chapters, difficulty, section, marks, count, exclude=(), exclude_paper=None):
+        """
+        Up to `count` distinct questions for one kind of slot, closest in difficulty first and shuffled
+        within that. With `chapters`, only questions from papers limited to those chapters qualify.
+        Questions that appear in `exclude_paper` (the layout's own paper) never qualify.
+        """
+        chapter_filter = ""
+        params = [board, class_level, subject, section, marks, difficulty, BANK_DIFFICULTY_TOLERANCE]
+        if chapters:
+            chapter_filter = (
+                "AND chapters != '[]' AND NOT EXISTS (SELECT 1 FROM json_each(chapters) "
+                f"WHERE value NOT IN ({', '.join('?' * len(chapters))})) "
+            )
+            params += list(chapters)
+        params += list(exclude)
+        params += [str(exclude_paper), difficulty, count]
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT text, digest FROM bank_questions WHERE source = 'generated' AND board = ? AND class_level = ? "
+                "AND subject = ? AND section = ? AND marks IS ? AND abs(difficulty - ?) <= ? "
+                f"{chapter_filter}AND digest NOT IN ({', '.join('?' * len(exclude))}) "
+                "AND digest NOT IN (SELECT digest FROM bank_questions WHERE source = 'generated' AND paper_id = ?) "
+                "GROUP BY digest ORDER BY abs(difficulty - ?) / 10, random() LIMIT ?",
+                params
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, query, board=None, class_level=None, subject=None, marks=None, limit=20):
+        """Best FTS matches for `query` in question text and chapters, optionally narrowed by tags."""
+        filters, params = [], [_fts_query(query)]
+        for column, value in (("board", board), ("class_level", class_level), ("subject", subject), ("marks", marks)):
+            if value is not None:
+                filters.append(f"AND q.{column} = ?")
+                params.append(value)
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT q.id, q.source, q.paper_id, q.board, q.class_level, q.subject, q.chapters, q.difficulty, "
+                "q.section, q.marks, q.text FROM bank_search JOIN bank_questions q ON q.id = bank_search.rowid "
+                f"WHERE bank_search MATCH ? {' '.join(filters)} ORDER BY bm25(bank_search) LIMIT ?",
+                params
+            ).fetchall()
+        return [{**dict(row), "chapters": json.loads(row["chapters"])} for row in rows]
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT source, COUNT(*) AS questions, COUNT(DISTINCT paper_id) AS papers, "
+                "COUNT(DISTINCT digest) AS distinct_questions FROM bank_questions GROUP BY source"
+            ).fetchall()
+        return {row["source"]: {k: row[k] for k in ("papers", "questions", "distinct_questions")} for row in rows}
+
+question_bank = Lazy(lambda: QuestionBank(QUESTION_BANK_DB_PATH))
+
+# --- ASSEMBLY ---
+def _gap_sections(layout, slots):
+    """The slots still empty, as [(section title, marks, count)] in paper order."""
+    gaps = []
+    for section in layout["sections"]:
+        missing = {}
+        for marks, text in zip(section["marks"], slots[section["title"]]):
+            if text is None:
+                missing[marks] = missing.get(marks, 0) + 1
+        gaps += [(section["title"], marks, count) for marks, count in missing.items()]
+    return gaps
+
+def assemble_paper(class_level, subject, chapters, difficulty, board, write_questions):
+    """
+    Builds a paper in the layout of the latest generated paper for this board/class/subject, filling
+    each question slot from the bank and calling `write_questions(gaps)` (gaps: [(section, marks, count)],
+    returns paper-style markdown) once for whatever is left. Returns (paper_text, stats), or None when
+    there is no layout yet, the bank covers less than BANK_MIN_COVERAGE, or the gaps stay unfilled.
+    """
+    template = question_bank.template(board, class_level, subject)
+    if template is None:
+        return None
+    # The template paper's own questions are left out, or a small bank would hand that paper back
+    template_id, layout = template
+
+    slots = {}
+    used = []
+    for section in layout["sections"]:
+        wanted = {}
+        for marks in section["marks"]:
+            wanted[marks] = wanted.get(marks, 0) + 1
+        picked = {}
+        for marks, count in wanted.items():
+            rows = question_bank.pick(
+                board, class_level, subject, chapters, difficulty, section["title"], marks, count, used, template_id
+            )
+            used += [row["digest"] for row in rows]
+            picked[marks] = [row["text"] for row in rows]
+        slots[section["title"]] = [picked[marks].pop(0) if picked[marks] else None for marks in section["marks"]]
+
+    total = sum(len(section["marks"]) for section in layout["sections"])
+    from_bank = total - sum(count for _, _, count in _gap_sections(layout, slots))
+    if total == 0 or from_bank / total < BANK_MIN_COVERAGE:
+        return None
+
+    gaps = _gap_sections(layout, slots)
+    if gaps:
+        _, written, _ = parse_paper(write_questions(gaps))
+        fresh = {}
+        for section in written:
+            fresh.setdefault(section["title"], []).extend(q["text"] for q in section["questions"])
+        for section in layout["sections"]:
+            texts = fresh.get(section["title"], [])
+            slots[section["title"]] = [text if text is not None or not texts else texts.pop(0) for text in slots[section["title"]]]
+        if _gap_sections(layout, slots):
+            return None
+
+    sections = [
+        {"heading": section["heading"], "questions": [{"text": text} for text in slots[section["title"]]]}
+        for section in layout["sections"]
+    ]
+    paper_text = render_paper(layout["header"], sections, layout["numbering"])
+    return paper_text, {"questions": total, "from_bank": from_bank, "generated": total - from_bank}
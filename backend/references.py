@@ -0,0 +1,140 @@
+import os
+import re
+import time
+from cache import DATA_DIR, Lazy, open_store
+
+# Solved papers indexed per question, so evaluation sends only the questions a script answers
+REFERENCES_DB_PATH = os.path.join(DATA_DIR, "references.sqlite3")
+
+PAGE_HEADER = re.compile(r"^##\s*---\s*Page\s+(\d+)\s+(Solution|Error)\s*---\s*$", re.MULTILINE)
+QUESTION_HEADER = re.compile(r"^[ \t]*\*\*Q\.?\s*(\d+[A-Za-z]?)\b(.*)$", re.MULTILINE)
+MARKS = re.compile(r"(\d+(?:\.\d+)?)\s*Marks?", re.IGNORECASE)
+
+def parse_solution(markdown):
+    """
+    Splits solution markdown (as written by solver.format_page_solution) into questions.
+    Returns [{"number", "page", "marks", "text"}] in paper order. Text before a page's first
+    question continues the previous question; a page with no question headers becomes one
+    entry with number None. Error pages are skipped.
+    """
+    questions = []
+    by_number = {}
+    headers = list(PAGE_HEADER.finditer(markdown or ""))
+    for i, header in enumerate(headers):
+        if header.group(2) == "Error":
+            continue
+        page = int(header.group(1))
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(markdown)
+        body = markdown[header.end():end].strip()
+        if not body:
+            continue
+
+        starts = list(QUESTION_HEADER.finditer(body))
+        lead = body[:starts[0].start()].strip() if starts else body
+        if lead:
+            if questions:
+                questions[-1]["text"] += "\n\n" + lead
+            else:
+                questions.append({"number": None, "page": page, "marks": None, "text": lead})
+
+        for j, start in enumerate(starts):
+            text = body[start.start():starts[j + 1].start() if j + 1 < len(starts) else len(body)].strip()
+            number = start.group(1).upper()
+            if number in by_number:
+                # OR-alternatives and questions restated on a later page share one entry
+                by_number[number]["text"] += "\n\n" + text
+                continue
+            marks = MARKS.search(start.group(2))
+            question = {"number": number, "page": page, "marks": marks.group(1) if marks else None, "text": text}
+            by_number[number] = question
+            questions.append(question)
+    return questions
+
+def parse_question_selection(selection):
+    """'1-5, 8, 12a' -> {"1", "2", "3", "4", "5", "8", "12A"}. None or blank selects everything."""
+    if not selection or not selection.strip():
+        return None
+    wanted = set()
+    for part in selection.split(","):
+        part = part.strip().upper().lstrip("Q")
+        if not part:
+            continue
+        if "-" in part:
+            low, _, high = part.partition("-")
+            try:
+                low, high = int(low), int(high.strip().lstrip("Q"))
+            except ValueError:
+                raise ValueError(f"Invalid question range: {part}")
+            if high < low:
+                raise ValueError(f"Invalid question range: {part}")
+            wanted.update(str(n) for n in range(low, high + 1))
+        elif re.fullmatch(r"\d+[A-Z]?", part):
+            wanted.add(part)
+        else:
+            raise ValueError(f"Invalid question number: {part}")
+    return wanted
+
+def _selected(question, wanted):
+    number = question["number"]
+    # "12" selects 12A and 12B; "12A" selects only that part
+    return number is not None and (number in wanted or number.rstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ") in wanted)
+
+def render_reference(questions, wanted=None):
+    """Reference text for the evaluator prompt; only the `wanted` question numbers if given."""
+    if wanted is not None:
+        questions = [q for q in questions if _selected(q, wanted)]
+    return "\n\n".join(q["text"] for q in questions)
+
+class ReferenceStore:
+    """SQLite index of reference solutions by paper_id."""
+
+    def __init__(self, path):
+        self.lock, self.conn = open_store(path, """
+            CREATE TABLE IF NOT EXISTS reference_papers (
+                paper_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reference_questions (
+                paper_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                number TEXT,
+                page INTEGER NOT NULL,
+                marks TEXT,
+                text TEXT NOT NULL,
+                PRIMARY KEY (paper_id, position)
+            );
+        """)
+
+    def save(self, paper_id, markdown):
+        """(Re)indexes a paper's solution markdown. Returns the number of entries stored."""
+        questions = parse_solution(markdown)
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM reference_questions WHERE paper_id = ?", (str(paper_id),))
+            self.conn.executemany(
+                "INSERT INTO reference_questions (paper_id, position, number, page, marks, text) VALUES (?, ?, ?, ?, ?, ?)",
+                [(str(paper_id), i, q["number"], q["page"], q["marks"], q["text"]) for i, q in enumerate(questions)]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reference_papers (paper_id, updated_at) VALUES (?, ?)", (str(paper_id), time.time())
+            )
+        return len(questions)
+
+    def get(self, paper_id):
+        """The indexed questions of a paper in order, or None if it was never indexed."""
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM reference_papers WHERE paper_id = ?", (str(paper_id),)).fetchone() is None:
+                return None
+            rows = self.conn.execute(
+                "SELECT number, page, marks, text FROM reference_questions WHERE paper_id = ? ORDER BY position",
+                (str(paper_id),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, paper_id):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM reference_questions WHERE paper_id = ?", (str(paper_id),))
+            self.conn.execute("DELETE FROM reference_papers WHERE paper_id = ?", (str(paper_id),))
+
+reference_store = Lazy(lambda: ReferenceStore(REFERENCES_DB_PATH))
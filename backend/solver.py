@@ -1,18 +1,50 @@
 import os
-import google.generativeai as genai
-from dotenv import load_dotenv
-from PIL import Image
-import io
 import re
 import time
-
-load_dotenv()
+import hashlib
+import random
+import threading
+import contextvars
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from dotenv import load_dotenv
+from cache import solution_cache
+from imaging import prepare_image
+from contextlib import contextmanager
+from metrics import (
+    span, record_model_call, record_usage, model_kind,
+    MODEL_QUEUE_DEPTH, MODEL_QUEUE_WAIT_SECONDS, MODEL_IN_FLIGHT
+)
 
 Solver_Model="gemini-3-flash-preview" # Updated to latest stable or preview if preferred
 Evaluation_Model="gemini-3-flash-preview"
 Generator_Model="gemini-3-flash-preview"
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", "64"))  # GenerativeModel objects kept per (model, system prompt)
+
+# Concurrent solving: pages in flight per paper
+SOLVER_CONCURRENCY = int(os.getenv("SOLVER_CONCURRENCY", "4"))
+
+# Global scheduler every model call goes through: one request budget for all kinds and teachers
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "8"))                    # requests in flight
+MODEL_RPM = int(os.getenv("MODEL_RPM", os.getenv("SOLVER_RPM", "60")))          # SOLVER_RPM is the old, solve-only name
+MODEL_PRIORITY_AGING = float(os.getenv("MODEL_PRIORITY_AGING", "30"))           # seconds queued that lift a call one class
+MODEL_PRIORITIES = {"evaluate": 0, "generate": 1, "solve": 2}                   # interactive first, bulk pages last
+
+# Packing: consecutive light pages share one request, within an image and output-token budget
+SOLVER_PACK_PAGES = int(os.getenv("SOLVER_PACK_PAGES", "4"))                           # 1 disables packing
+SOLVER_PACK_LIGHT_PAGE_BYTES = int(os.getenv("SOLVER_PACK_LIGHT_PAGE_BYTES", "150000"))  # denser pages go alone
+SOLVER_PACK_MAX_IMAGE_BYTES = int(os.getenv("SOLVER_PACK_MAX_IMAGE_BYTES", "600000"))
+SOLVER_PACK_PAGE_TOKENS = int(os.getenv("SOLVER_PACK_PAGE_TOKENS", "1500"))            # expected output per page
+
+# Retry policy shared by every model call
+MODEL_MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", "4"))
+MODEL_BACKOFF_BASE = float(os.getenv("MODEL_BACKOFF_BASE", "1.0"))
+MODEL_BACKOFF_MAX = float(os.getenv("MODEL_BACKOFF_MAX", "30"))
+MODEL_RETRY_BUDGET = int(os.getenv("MODEL_RETRY_BUDGET", "8"))  # retries per request (paper, script, generation)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
 
 # 1. DISABLE SAFETY FILTERS 
 safety_settings = [
@@ -169,75 +201,630 @@ FORMATTING RULES (Markdown + HTML):
    - Marks should be indicated in brackets at the end of the line, e.g. **[4 marks]**.
 """ + LATEX_RULES
 
-def get_latex_solution_stream(image_inputs):
+class RateLimiter:
+    """Token bucket limiter shared by every thread that calls the model."""
+
+    def __init__(self, requests_per_minute, burst=1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Takes a token if one is available. Returns 0, or the seconds until the next token."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+# --- SCHEDULER ---
+# Teacher the current request works for (X-Teacher-Id, see main.py); solve jobs carry it to their worker
+current_teacher = contextvars.ContextVar("teacher", default=None)
+
+class _Waiter:
+    __slots__ = ("kind", "rank", "teacher", "seq", "queued_at")
+
+    def __init__(self, kind, teacher, seq):
+        self.kind = kind
+        self.rank = MODEL_PRIORITIES.get(kind, len(MODEL_PRIORITIES))
+        self.teacher = teacher
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+class ModelScheduler:
     """
-    Solves the paper PAGE BY PAGE and YIELDS progress.
-    Yields: (current_page_index, total_pages, accumulated_text)
+    Admits model requests under a global concurrency and RPM cap. The next request is taken from the
+    highest priority class (MODEL_PRIORITIES, lifted one class per MODEL_PRIORITY_AGING seconds waited so
+    bulk work is never starved), and within a class from the teacher admitted least often while active,
+    oldest first. A teacher becoming active starts level with the others, so teachers take turns whatever
+    their backlog. Blocking; called from worker threads.
     """
-    full_solution_text = ""
-    model = genai.GenerativeModel(
-        model_name=Solver_Model, 
-        system_instruction=SOLVER_SYSTEM_PROMPT,
+
+    def __init__(self, concurrency, requests_per_minute, aging):
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(requests_per_minute, burst=self.concurrency)
+        self.aging = aging
+        self.changed = threading.Condition()
+        self.waiting = []
+        self.in_flight = 0
+        self.teacher_in_flight = {}
+        self.served = {}  # teacher -> admissions while the teacher has requests queued or in flight
+        self.admitted = 0
+        self.seq = 0
+
+    def _effective_rank(self, waiter, now):
+        if self.aging <= 0:
+            return waiter.rank
+        return max(0, waiter.rank - int((now - waiter.queued_at) // self.aging))
+
+    def _next(self):
+        now = time.monotonic()
+        return min(self.waiting, key=lambda w: (
+            self._effective_rank(w, now), self.served[w.teacher], w.seq
+        ))
+
+    def _forget_idle(self, teacher):
+        if not self.teacher_in_flight.get(teacher) and not any(w.teacher == teacher for w in self.waiting):
+            self.served.pop(teacher, None)
+
+    def acquire(self, kind, teacher=None):
+        with self.changed:
+            self.seq += 1
+            waiter = _Waiter(kind, teacher, self.seq)
+            if teacher not in self.served:
+                self.served[teacher] = min(self.served.values(), default=0)
+            self.waiting.append(waiter)
+            MODEL_QUEUE_DEPTH.labels(kind).inc()
+            self.changed.notify_all()
+            try:
+                while True:
+                    # Re-checked at least every second: waiting time changes the order through aging
+                    wait = 1.0
+                    if self.in_flight < self.concurrency and self._next() is waiter:
+                        wait = self.limiter.try_acquire()
+                        if not wait:
+                            break
+                    self.changed.wait(min(wait, 1.0))
+            except BaseException:
+                self.waiting.remove(waiter)
+                MODEL_QUEUE_DEPTH.labels(kind).dec()
+                self._forget_idle(teacher)
+                self.changed.notify_all()
+                raise
+            self.waiting.remove(waiter)
+            MODEL_QUEUE_DEPTH.labels(kind).dec()
+            self.served[teacher] += 1
+            self.in_flight += 1
+            self.teacher_in_flight[teacher] = self.teacher_in_flight.get(teacher, 0) + 1
+            self.admitted += 1
+            MODEL_IN_FLIGHT.set(self.in_flight)
+            self.changed.notify_all()
+        MODEL_QUEUE_WAIT_SECONDS.labels(kind).observe(time.monotonic() - waiter.queued_at)
+
+    def release(self, teacher=None):
+        with self.changed:
+            self.in_flight -= 1
+            self.teacher_in_flight[teacher] -= 1
+            if not self.teacher_in_flight[teacher]:
+                del self.teacher_in_flight[teacher]
+                self._forget_idle(teacher)
+            MODEL_IN_FLIGHT.set(self.in_flight)
+            self.changed.notify_all()
+
+    @contextmanager
+    def slot(self, kind, teacher=None):
+        self.acquire(kind, teacher)
+        try:
+            yield
+        finally:
+            self.release(teacher)
+
+    def stats(self):
+        with self.changed:
+            queued = {}
+            for waiter in self.waiting:
+                queued[waiter.kind] = queued.get(waiter.kind, 0) + 1
+            return {
+                "in_flight": self.in_flight, "concurrency": self.concurrency, "rpm": MODEL_RPM,
+                "queued": queued, "active_teachers": len(self.served), "admitted": self.admitted,
+            }
+
+model_scheduler = ModelScheduler(MODEL_CONCURRENCY, MODEL_RPM, MODEL_PRIORITY_AGING)
+
+# --- MODEL CALL POLICY (retries, budget, circuit breaker) ---
+class ModelCallError(Exception):
+    """A model call that failed for good. `retryable` tells callers whether trying later may help."""
+
+    def __init__(self, message, retryable, attempts=()):
+        super().__init__(message)
+        self.retryable = retryable
+        self.attempts = list(attempts)  # latency in seconds of every attempt made
+
+class CircuitOpenError(ModelCallError):
+    pass
+
+def is_retryable(exc):
+    """Transient failures (quota, overload, timeouts) are retried; bad requests and blocked content are not."""
+    from google.api_core import exceptions as api_exceptions
+    if isinstance(exc, (
+        api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable,
+        api_exceptions.InternalServerError, api_exceptions.DeadlineExceeded,
+        api_exceptions.TooManyRequests, api_exceptions.GatewayTimeout,
+        ConnectionError, TimeoutError
+    )):
+        return True
+    if isinstance(exc, (api_exceptions.GoogleAPICallError, ValueError)):
+        return False
+    message = str(exc).lower()
+    return any(marker in message for marker in ("429", "500", "503", "504", "quota", "overloaded", "unavailable", "deadline"))
+
+class RetryBudget:
+    """Caps the number of retries one request may spend across all of its model calls."""
+
+    def __init__(self, retries=None):
+        self.remaining = MODEL_RETRY_BUDGET if retries is None else retries
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class CircuitBreaker:
+    """
+    Opens after consecutive transient failures so callers fail fast while the API is down.
+    Once the cooldown has passed it is half-open: one probe call at a time goes through, and its
+    result closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None  # when the current half-open probe was let through
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # A probe that never reported back (e.g. its thread died) stops blocking after a cooldown
+            if self.probe_at is not None and now - self.probe_at < self.cooldown:
+                return False
+            self.probe_at = now
+            return True
+
+    def release_probe(self):
+        """The probe ended without saying anything about the API's health (e.g. a rejected request)."""
+        with self.lock:
+            self.probe_at = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Model circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+            self.probe_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+model_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+
+# --- GEMINI CLIENT (lazy) ---
+# google.generativeai takes most of the app's import time, so it is imported and
+# configured on the first model call instead of when the worker boots.
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                # Also from .env, for scripts that import the solver without main.py
+                load_dotenv()
+                api_key = os.getenv("GEMINI_API_KEY")
+                if not api_key:
+                    raise ModelCallError("GEMINI_API_KEY is not set", False)
+                import google.generativeai as genai
+                genai.configure(api_key=api_key)
+                _genai = genai
+    return _genai
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def get_model(model_name, system_instruction):
+    """Shared GenerativeModel per (model, system prompt); safe to use from several threads."""
+    return get_genai().GenerativeModel(
+        model_name=model_name,
+        system_instruction=system_instruction,
         generation_config=generation_config,
         safety_settings=safety_settings
     )
-    
-    total_pages = len(image_inputs)
-    print(f"Processing {total_pages} pages...")
-    
-    for i, item in enumerate(image_inputs):
+
+_attempt_stats = {"attempts": 0, "successes": 0, "retries": 0, "failures": 0, "fast_failures": 0}
+_recent_latencies = deque(maxlen=1000)
+_stats_lock = threading.Lock()
+
+def _record_attempt(label, latency, outcome):
+    with _stats_lock:
+        _attempt_stats["attempts"] += 1
+        _recent_latencies.append(latency)
+    print(f"Model call [{label}] {outcome} in {latency:.2f}s")
+
+def _count(stat):
+    with _stats_lock:
+        _attempt_stats[stat] += 1
+
+def model_call_stats():
+    with _stats_lock:
+        stats = dict(_attempt_stats)
+        latencies = sorted(_recent_latencies)
+    if latencies:
+        stats["latency_p50"] = latencies[len(latencies) // 2]
+        stats["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    stats["circuit"] = model_breaker.state
+    stats["scheduler"] = model_scheduler.stats()
+    return stats
+
+def call_model(fn, label, budget=None, hold_slot=False):
+    """
+    Runs `fn()` (one model request) with exponential backoff and full jitter.
+    Every attempt waits its turn in model_scheduler, by the kind in `label` and the current teacher.
+    Only retryable errors are retried, each retry spends from `budget`, and an open
+    circuit fails fast. Raises ModelCallError when the call cannot succeed.
+    With `hold_slot`, a successful call keeps its scheduler slot; the caller releases it.
+    """
+    kind = model_kind(label)
+    teacher = current_teacher.get()
+    attempts = []
+    for attempt in range(1, MODEL_MAX_ATTEMPTS + 1):
+        if not model_breaker.allow():
+            _count("fast_failures")
+            raise CircuitOpenError("Gemini API is unavailable (circuit open); try again shortly", True, attempts)
+        with span("model.queue_wait"):
+            model_scheduler.acquire(kind, teacher)
+
+        started = time.monotonic()
         try:
-            img = None
-            if isinstance(item, io.BytesIO):
-                item.seek(0)
-                img = Image.open(item)
+            try:
+                result = fn()
+            except BaseException:
+                # The slot is freed before any backoff sleep
+                model_scheduler.release(teacher)
+                raise
+            if not hold_slot:
+                model_scheduler.release(teacher)
+        except Exception as e:
+            latency = time.monotonic() - started
+            attempts.append(latency)
+            retryable = is_retryable(e)
+            _record_attempt(label, latency, f"failed ({'retryable' if retryable else 'fatal'}: {e})")
+            record_model_call(label, latency, "retryable_error" if retryable else "fatal_error")
+            if retryable:
+                model_breaker.record_failure()
             else:
-                img = item 
-            
-            print(f"Solving Page {i+1}...")
-            # Yield progress before starting the heavy generation
-            # We yield the previous text + a marker or just the state
-            
-            response = model.generate_content([
-                f"Solve all questions present on Page {i+1} of this exam paper.", 
-                img
-            ])
-            page_content = response.text if response.text else "*[No text generated for this page]*"
-            
-            full_solution_text += f"\n\n## --- Page {i+1} Solution ---\n\n{page_content}"
-            
-            # Yield progress update
-            yield (i + 1, total_pages, full_solution_text)
-            
-            time.sleep(1) # Avoid rate limits
+                model_breaker.release_probe()
+            if not retryable or attempt == MODEL_MAX_ATTEMPTS or (budget is not None and not budget.spend()):
+                _count("failures")
+                raise ModelCallError(str(e), retryable, attempts) from e
+            _count("retries")
+            with span("model.backoff"):
+                time.sleep(random.uniform(0, min(MODEL_BACKOFF_MAX, MODEL_BACKOFF_BASE * 2 ** (attempt - 1))))
+            continue
+
+        latency = time.monotonic() - started
+        attempts.append(latency)
+        _record_attempt(label, latency, "ok")
+        record_model_call(label, latency, "ok")
+        _count("successes")
+        model_breaker.record_success()
+        return result
+
+def stream_model(fn, label, usage_kind, budget=None):
+    """
+    Opens a streaming request (`fn()`) through call_model and yields its text as it arrives.
+    The scheduler slot is held until the stream is consumed or closed, not just opened,
+    so a stream counts against MODEL_CONCURRENCY for as long as it runs.
+    """
+    teacher = current_teacher.get()
+    response = call_model(fn, label, budget=budget, hold_slot=True)
+    try:
+        for chunk in response:
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+    finally:
+        model_scheduler.release(teacher)
+    # usage_metadata is complete once the stream has been consumed
+    record_usage(usage_kind, response)
+
+def page_cache_key(payload):
+    """Content hash of a prepared page image plus everything else that shapes the answer."""
+    digest = hashlib.sha256()
+    digest.update(Solver_Model.encode())
+    digest.update(b"\0")
+    digest.update(SOLVER_SYSTEM_PROMPT.encode())
+    digest.update(b"\0")
+    digest.update(payload["mime_type"].encode())
+    digest.update(payload["data"])
+    return digest.hexdigest()
+
+def _prepare_page(item, page_number):
+    """
+    Waits for the render, optimizes the image and consults the cache.
+    Returns (content, None, None) for blank or cached pages, else (None, payload, cache_key).
+    """
+    if isinstance(item, Future):
+        # Page is still being rasterized on the render pool
+        with span("solve.render_wait"):
+            item = item.result()
+
+    with span("solve.prepare_image"):
+        payload = prepare_image(item)
+    if payload is None:
+        print(f"Page {page_number} is blank, skipping")
+        return "*[Blank page skipped]*", None, None
+
+    key = page_cache_key(payload)
+    with span("solve.cache_lookup"):
+        cached = solution_cache.get(key)
+    if cached is not None:
+        print(f"Page {page_number} served from cache")
+        return cached.decode("utf-8"), None, None
+    return None, payload, key
+
+def _solve_page(model, page_number, payload, key, budget=None):
+    """One request for one page. Runs on a worker thread."""
+    print(f"Solving Page {page_number}...")
+    label = f"solve page {page_number}"
+    page_content = call_model(lambda: record_usage(label, model.generate_content([
+        f"Solve all questions present on Page {page_number} of this exam paper.",
+        payload
+    ])).text, label, budget=budget)
+    if not page_content:
+        return "*[No text generated for this page]*"
+    solution_cache.set(key, page_content.encode("utf-8"))
+    return page_content
+
+PAGE_MARKER = re.compile(r"^[ \t]*<<<\s*PAGE\s+(\d+)\s*>>>[ \t]*$", re.MULTILINE)
+
+def split_packed_response(text, page_numbers):
+    """Splits a packed answer on its <<<PAGE n>>> markers. Returns {page_number: content} for the pages found."""
+    markers = list(PAGE_MARKER.finditer(text or ""))
+    sections = {}
+    for i, marker in enumerate(markers):
+        page_number = int(marker.group(1))
+        content = text[marker.end():markers[i + 1].start() if i + 1 < len(markers) else len(text)].strip()
+        if page_number in page_numbers and content:
+            sections[page_number] = sections[page_number] + "\n\n" + content if page_number in sections else content
+    return sections
+
+def _solve_group(model, group, budget=None):
+    """
+    Solves [(page_number, payload, key)] and returns {page_number: content or exception}.
+    Several pages go in one request; pages missing from the split answer (or a request
+    rejected outright) fall back to one request per page.
+    """
+    results = {}
+    if len(group) > 1:
+        numbers = [page_number for page_number, _, _ in group]
+        label = f"solve pages {numbers[0]}-{numbers[-1]}"
+        print(f"Solving Pages {', '.join(map(str, numbers))} in one request...")
+        content = [
+            f"Solve all questions present on Pages {', '.join(map(str, numbers))} of this exam paper. "
+            f"The {len(group)} page images follow in order. Start each page's solutions with a line "
+            f"containing only <<<PAGE n>>> (n = the page number), and cover every page."
+        ]
+        for page_number, payload, _ in group:
+            content += [f"Page {page_number}:", payload]
+        try:
+            text = call_model(
+                lambda: record_usage(label, model.generate_content(content)).text, label, budget=budget
+            )
+            for page_number, section in split_packed_response(text, set(numbers)).items():
+                results[page_number] = section
+        except ModelCallError as e:
+            if e.retryable:
+                return {page_number: e for page_number in numbers}
+            print(f"Packed request for pages {numbers} rejected ({e}); solving them one by one")
+        if results:
+            for page_number, _, key in group:
+                if page_number in results:
+                    solution_cache.set(key, results[page_number].encode("utf-8"))
+        missing = [page for page in group if page[0] not in results]
+        if missing and results:
+            print(f"Packed answer had no section for page(s) {[page[0] for page in missing]}; solving them alone")
+        group = missing
+
+    for page_number, payload, key in group:
+        try:
+            results[page_number] = _solve_page(model, page_number, payload, key, budget)
         except Exception as e:
-            print(f"Error on Page {i+1}: {e}")
-            full_solution_text += f"\n\n## --- Page {i+1} Error ---\nCould not solve this page. Error: {str(e)}\n"
-            yield (i + 1, total_pages, full_solution_text)
+            results[page_number] = e
+    return results
+
+def format_page_solution(page_number, page_content=None, error=None):
+    """Markdown section for one page, as stored in the solution file."""
+    if error is not None:
+        return f"\n\n## --- Page {page_number} Error ---\nCould not solve this page. Error: {error}\n"
+    return f"\n\n## --- Page {page_number} Solution ---\n\n{page_content}"
+
+def solve_pages(pages, concurrency=None, pack=None):
+    """
+    Solves (page_number, image) pairs with up to `concurrency` requests in flight.
+    Images may be PIL images, photo paths, BytesIO or render Futures from imaging.iter_pdf_pages.
+    Up to `pack` consecutive light pages share one request (see SOLVER_PACK_*).
+    Yields (page_number, page_content, error) in input order; exactly one of content/error is None.
+    `error` is the exception (a ModelCallError for model failures).
+    """
+    model = get_model(Solver_Model, SOLVER_SYSTEM_PROMPT)
+    concurrency = max(1, concurrency or SOLVER_CONCURRENCY)
+    pack = max(1, min(
+        pack or SOLVER_PACK_PAGES,
+        generation_config["max_output_tokens"] // max(1, SOLVER_PACK_PAGE_TOKENS)
+    ))
+    budget = RetryBudget()
+
+    pages = iter(pages)
+    in_flight = deque()  # ([page_numbers], Future of {page_number: content or exception})
+    group = []           # light pages waiting to be packed
+    group_bytes = 0
+
+    def submit(unit):
+        numbers = [page_number for page_number, _, _ in unit]
+        # copy_context: spans in the worker thread still count towards the caller's timings
+        in_flight.append((numbers, pool.submit(contextvars.copy_context().run, _solve_group, model, unit, budget)))
+
+    def finished(page_number, content):
+        future = Future()
+        future.set_result({page_number: content})
+        in_flight.append(([page_number], future))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            exhausted = False
+            while True:
+                # Keep the window full, pulling pages lazily from the input
+                while len(in_flight) < concurrency and not exhausted:
+                    page = next(pages, None)
+                    if page is None:
+                        exhausted = True
+                        break
+                    page_number, item = page
+                    try:
+                        content, payload, key = _prepare_page(item, page_number)
+                    except Exception as e:
+                        content, payload, key = e, None, None
+                    size = len(payload["data"]) if payload is not None else 0
+                    light = payload is not None and pack > 1 and size <= SOLVER_PACK_LIGHT_PAGE_BYTES
+                    # Close the open group when this page can't join it (results must stay in page order)
+                    if group and (not light or len(group) >= pack or group_bytes + size > SOLVER_PACK_MAX_IMAGE_BYTES):
+                        submit(group)
+                        group, group_bytes = [], 0
+                    if payload is None:
+                        finished(page_number, content)
+                    elif light:
+                        group.append((page_number, payload, key))
+                        group_bytes += size
+                    else:
+                        submit([(page_number, payload, key)])
+                if group and (exhausted or len(group) >= pack or not in_flight):
+                    submit(group)
+                    group, group_bytes = [], 0
+                if not in_flight:
+                    break
+
+                numbers, future = in_flight.popleft()
+                results = future.result()
+                for page_number in numbers:
+                    result = results[page_number]
+                    if isinstance(result, Exception):
+                        print(f"Error on Page {page_number}: {result}")
+                        yield (page_number, None, result)
+                    else:
+                        yield (page_number, result, None)
+        finally:
+            # Consumer went away: don't start pages nobody will read
+            for _, future in in_flight:
+                future.cancel()
+
+def get_latex_solution_stream(image_inputs, total_pages=None, concurrency=None, pack=None):
+    """
+    Solves the paper with up to `concurrency` requests in flight and YIELDS progress in page order.
+    Light pages may share a request (`pack`, see solve_pages); progress is still reported per page.
+    `image_inputs` may be any iterable (images, BytesIO or render Futures from imaging.iter_pdf_pages);
+    pass `total_pages` when it has no len().
+    Yields: (current_page_index, total_pages, accumulated_text)
+    """
+    full_solution_text = ""
+    if total_pages is None:
+        total_pages = len(image_inputs)
+    print(f"Processing {total_pages} pages...")
+
+    for page_number, page_content, error in solve_pages(enumerate(image_inputs, start=1), concurrency, pack):
+        full_solution_text += format_page_solution(page_number, page_content, error)
+        # Yield progress update
+        yield (page_number, total_pages, full_solution_text)
 
     # Return is not possible in generator, the last yield contains the full text
 
+BLANK_SUBMISSION_REPORT = "## Student Evaluation Report\n\nThe submission is blank; nothing was graded.\n\n**Total Score:** 0 / 0"
+
+def _chunk_text(chunk):
+    """Text of one streamed chunk; safety/finish-only chunks carry none."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+def _evaluation_request(student_images, reference_solution_text):
+    """Builds the evaluator model and content. Returns None when every page is blank."""
+    # Prepare content list: Prompt string followed by all non-blank pages
+    pages = [p for p in map(prepare_image, student_images) if p is not None]
+    if not pages:
+        return None
+
+    model = get_model(Evaluation_Model, EVALUATOR_SYSTEM_PROMPT)
+    content = [f"Reference Solution:\n{reference_solution_text}\n\nEvaluate the following student submission pages."]
+    content.extend(pages)
+    return model, content
+
 def evaluate_student_solution(student_images, reference_solution_text):
     """
     Evaluates student submission which can be multiple images.
     """
-    model = genai.GenerativeModel(
-        model_name=Evaluation_Model,
-        system_instruction=EVALUATOR_SYSTEM_PROMPT,
-        generation_config=generation_config,
-        safety_settings=safety_settings
-    )
-    
-    # Prepare content list: Prompt string followed by all images
-    content = [f"Reference Solution:\n{reference_solution_text}\n\nEvaluate the following student submission pages."]
-    content.extend(student_images)
+    request = _evaluation_request(student_images, reference_solution_text)
+    if request is None:
+        return BLANK_SUBMISSION_REPORT
+    model, content = request
     
     try:
-        response = model.generate_content(content)
-        return response.text
-    except Exception as e:
+        return call_model(
+            lambda: record_usage("evaluate", model.generate_content(content)).text, "evaluate", budget=RetryBudget()
+        )
+    except ModelCallError as e:
+        # Raised, not returned: an error string must never be graded as a report
         print(f"Evaluation Error: {e}")
-        return f"Error: Could not generate evaluation report. Details: {str(e)}"
+        raise
+
+def evaluate_student_solution_stream(student_images, reference_solution_text):
+    """
+    Streaming variant of evaluate_student_solution. Yields report text chunks as they arrive.
+    Errors are raised to the caller so a partial report is never mistaken for a finished one.
+    Only opening the stream is retried; a stream that breaks midway is not.
+    """
+    request = _evaluation_request(student_images, reference_solution_text)
+    if request is None:
+        yield BLANK_SUBMISSION_REPORT
+        return
+    model, content = request
+
+    yield from stream_model(
+        lambda: model.generate_content(content, stream=True), "evaluate (stream)", "evaluate", budget=RetryBudget()
+    )
 
 def extract_score(text):
     match = re.search(r"(?:Total\s*)?Score\s*[:\-]?\s*(\d+\s*[\/\\]\s*\d+)", text, re.IGNORECASE)
@@ -248,9 +835,50 @@ def extract_score(text):
     if matches: return matches[-1].replace(" ", "")
     return "N/A"
 
-def generate_paper(class_level, subject, chapters, difficulty, board):
-    """Generates a text-based question paper with Board-Specific Formatting."""
-    
+def _cell_number(cell):
+    match = re.search(r"-?\d+(?:\.\d+)?", cell)
+    return float(match.group()) if match else None
+
+def extract_question_marks(text):
+    """
+    Parses the report's grade table (Question | Status | Marks Awarded | Max Marks | ...).
+    Returns [{"question", "status", "awarded", "max"}] in table order; marks are floats or None.
+    """
+    columns = None
+    marks = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            columns = None
+            continue
+        cells = [cell.strip().strip("*").strip() for cell in line.strip("|").split("|")]
+        if columns is None:
+            header = [cell.lower() for cell in cells]
+            if "question" in header and any("award" in cell for cell in header):
+                columns = {
+                    "question": header.index("question"),
+                    "status": next((i for i, cell in enumerate(header) if cell == "status"), None),
+                    "awarded": next(i for i, cell in enumerate(header) if "award" in cell),
+                    "max": next((i for i, cell in enumerate(header) if "max" in cell), None),
+                }
+            continue
+        if set("".join(cells)) <= set(":- "):
+            continue  # alignment row
+        question = cells[columns["question"]] if columns["question"] < len(cells) else ""
+        if not question or question.lower().startswith("total"):
+            continue
+        cell = lambda name: cells[columns[name]] if columns[name] is not None and columns[name] < len(cells) else ""
+        status = cell("status").split("/")[0].split()
+        marks.append({
+            "question": question,
+            "status": status[0].lower() if status else None,
+            "awarded": _cell_number(cell("awarded")),
+            "max": _cell_number(cell("max")),
+        })
+    return marks
+
+def _generation_request(class_level, subject, chapters, difficulty, board):
+    """Builds the board-specific generator model and user prompt."""
     chapter_list_str = ", ".join(chapters) if chapters else "Full Syllabus"
     
     # Select the correct prompt based on the board
@@ -275,16 +903,60 @@ def generate_paper(class_level, subject, chapters, difficulty, board):
     Ensure questions are relevant to the selected chapters.
     """
     
-    model = genai.GenerativeModel(
-        model_name=Generator_Model,
-        system_instruction=sys_prompt,
-        generation_config=generation_config,
-        safety_settings=safety_settings
-    )
+    model = get_model(Generator_Model, sys_prompt)
+    return model, user_prompt
+
+def generate_paper(class_level, subject, chapters, difficulty, board):
+    """Generates a text-based question paper with Board-Specific Formatting."""
+    model, user_prompt = _generation_request(class_level, subject, chapters, difficulty, board)
     
     try:
-        response = model.generate_content(user_prompt)
-        return response.text
-    except Exception as e:
+        return call_model(
+            lambda: record_usage("generate", model.generate_content(user_prompt)).text, "generate", budget=RetryBudget()
+        )
+    except ModelCallError as e:
+        print(f"Generation Error: {e}")
+        raise
+
+def generate_paper_stream(class_level, subject, chapters, difficulty, board):
+    """Streaming variant of generate_paper. Yields paper text chunks; errors are raised."""
+    model, user_prompt = _generation_request(class_level, subject, chapters, difficulty, board)
+
+    yield from stream_model(
+        lambda: model.generate_content(user_prompt, stream=True), "generate (stream)", "generate", budget=RetryBudget()
+    )
+
+QUESTION_SETTER_PROMPT = r"""
+You are a {board} Examination Paper Setter writing extra questions for an existing CLASS {class_level} {subject} paper.
+FORMATTING RULES (Markdown):
+1. Write ONLY the questions asked for: no paper header, no instructions, no answers.
+2. Put each group under the exact section header given, e.g. `## SECTION B`.
+3. Number questions **1.**, **2.**, ... and end each question with its marks, e.g. **[2 marks]**.
+4. Leave TWO blank lines between questions.
+""" + LATEX_RULES
+
+def generate_questions(class_level, subject, chapters, difficulty, board, gaps):
+    """
+    Writes only the questions a bank-assembled paper is missing (see questionbank.assemble_paper).
+    gaps: [(section, marks, count)]. Returns markdown with `## <section>` headers and numbered questions.
+    """
+    chapter_list_str = ", ".join(chapters) if chapters else "Full Syllabus"
+    wanted = "\n".join(
+        f"- {section}: {count} question(s)" + (f" of {marks:g} marks each" if marks is not None else "")
+        for section, marks, count in gaps
+    )
+    user_prompt = f"""
+    Write these questions for a {board} {subject} paper.
+    Included Chapters: {chapter_list_str}
+    Difficulty Level: {difficulty}/100.
+
+    {wanted}
+    """
+    model = get_model(Generator_Model, QUESTION_SETTER_PROMPT.format(board=board, class_level=class_level, subject=subject))
+    try:
+        return call_model(
+            lambda: record_usage("generate", model.generate_content(user_prompt)).text, "generate (gaps)", budget=RetryBudget()
+        )
+    except ModelCallError as e:
         print(f"Generation Error: {e}")
-        return f"Error generating paper: {str(e)}"
\ No newline at end of file
+        raise
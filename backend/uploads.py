@@ -0,0 +1,203 @@
+import os
+import uuid
+import shutil
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager, aclosing
+from PIL import Image
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser, MultiPartException, parse_options_header
+from imaging import count_pdf_pages, remove_spooled
+from cache import DATA_DIR
+from metrics import UPLOAD_RESERVED_BYTES, UPLOAD_REJECTIONS
+
+# Uploads are spooled to disk and read from there (by path, or memory-mapped for storage uploads),
+# never held whole in memory. Limits turn oversized or overload-inducing requests into 413/503.
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")  # next to the job files, so handing a file to a job is a rename
+
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(50 * 1024 * 1024)))   # per file or zip entry
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(200 * 1024 * 1024)))  # body, and unpacked archives
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "500"))                             # files and zip entries per request
+UPLOAD_MAX_PAGES = int(os.getenv("UPLOAD_MAX_PAGES", "100"))                             # per paper or student script
+UPLOAD_INFLIGHT_BYTES = int(os.getenv("UPLOAD_INFLIGHT_BYTES", str(512 * 1024 * 1024)))  # rendered pages held per worker
+UPLOAD_PAGE_BYTES = int(os.getenv("UPLOAD_PAGE_BYTES", str(2 * 1024 * 1024)))            # estimated cost of one held page
+UPLOAD_QUEUE_SECONDS = float(os.getenv("UPLOAD_QUEUE_SECONDS", "30"))                    # wait for memory before a 503
+COPY_CHUNK_BYTES = 1024 * 1024
+
+def format_size(nbytes):
+    return f"{nbytes / (1024 * 1024):.0f} MB" if nbytes >= 1024 * 1024 else f"{nbytes} bytes"
+
+class UploadLimitError(Exception):
+    """An upload over a limit. `retryable` means the worker was busy (503), otherwise too large (413)."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+        UPLOAD_REJECTIONS.labels("busy" if retryable else "too_large").inc()
+
+# --- SPOOLING ---
+def spool_file(source, filename, content_type, max_bytes=UPLOAD_MAX_FILE_BYTES, too_large=None):
+    """
+    Streams a readable file object into UPLOAD_DIR in chunks, raising UploadLimitError (`too_large`) past `max_bytes`.
+    Returns {"filename", "content_type", "path", "size", "page_count"}; page_count is filled by count_pages.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename or "")[1], dir=UPLOAD_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as target:
+            while chunk := source.read(COPY_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadLimitError(too_large or f"{filename} exceeds {format_size(max_bytes)}")
+                target.write(chunk)
+    except BaseException:
+        remove_spooled(path)
+        raise
+    return {"filename": filename, "content_type": content_type, "path": path, "size": size, "page_count": None}
+
+async def spool_upload(upload):
+    """
+    Spools a FastAPI UploadFile without reading it into memory. Parts parsed by UploadRoute are already
+    in UPLOAD_DIR and are hard-linked rather than copied; the request's own name goes when the form closes.
+    """
+    if upload.size is not None and upload.size > UPLOAD_MAX_FILE_BYTES:
+        raise UploadLimitError(f"{upload.filename} exceeds {format_size(UPLOAD_MAX_FILE_BYTES)}")
+    name = getattr(upload.file, "name", None)
+    if isinstance(name, str) and os.path.dirname(name) == UPLOAD_DIR:
+        path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}{os.path.splitext(upload.filename or '')[1]}")
+        await asyncio.to_thread(upload.file.flush)
+        await asyncio.to_thread(os.link, name, path)
+        return {
+            "filename": upload.filename, "content_type": upload.content_type,
+            "path": path, "size": upload.size, "page_count": None,
+        }
+    await upload.seek(0)
+    return await asyncio.to_thread(spool_file, upload.file, upload.filename, upload.content_type)
+
+# --- MULTIPART PARSING ---
+class _UploadParser(MultiPartParser):
+    """Writes file parts straight to named temp files in UPLOAD_DIR, removed when the form is closed."""
+
+    def on_headers_finished(self):
+        super().on_headers_finished()
+        part = self._current_part
+        if part.file is None:
+            return
+        part.file.file.close()  # Starlette's (still empty) spooled file
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        target = tempfile.NamedTemporaryFile(suffix=os.path.splitext(part.file.filename or "")[1], dir=UPLOAD_DIR)
+        self._files_to_close_on_error.append(target)
+        part.file = UploadFile(file=target, size=0, filename=part.file.filename, headers=part.file.headers)
+
+class _UploadRequest(Request):
+    async def _get_form(self, **limits):
+        content_type, _ = parse_options_header(self.headers.get("Content-Type"))
+        if self._form is None and content_type == b"multipart/form-data":
+            try:
+                async with aclosing(self.stream()) as stream:
+                    self._form = await _UploadParser(self.headers, stream, **limits).parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(**limits)
+
+class UploadRoute(APIRoute):
+    """
+    Parses multipart bodies with _UploadParser, so each upload is written to disk once (and only for this
+    app, rather than by changing Starlette's parser for the whole process).
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def upload_route_handler(request):
+            return await handler(_UploadRequest(request.scope, request.receive))
+
+        return upload_route_handler
+
+def discard(files):
+    for f in files:
+        remove_spooled(f["path"])
+
+def move_spooled(f, path):
+    """Hands a spooled file over to its new owner (a job directory)."""
+    shutil.move(f["path"], path)
+    f["path"] = path
+
+async def count_pages(files):
+    """
+    Fills in page_count for each spooled file (PDFs are counted on the render pool, images are one page;
+    an unreadable PDF counts 0) and enforces UPLOAD_MAX_PAGES over the whole set.
+    """
+    for f in files:
+        if f["page_count"] is not None:
+            continue
+        if f["content_type"] != "application/pdf":
+            f["page_count"] = 1
+            continue
+        try:
+            f["page_count"] = await count_pdf_pages(f["path"])
+        except Exception as e:
+            print(f"Error converting PDF {f['filename']}: {e}")
+            f["page_count"] = 0
+    total = sum(f["page_count"] for f in files)
+    if total > UPLOAD_MAX_PAGES:
+        raise UploadLimitError(f"{total} pages exceeds the limit of {UPLOAD_MAX_PAGES}")
+    return total
+
+def estimate_memory(files):
+    """Bytes a request holds while its pages are rendered and graded."""
+    total = 0
+    for f in files:
+        if f["content_type"] == "application/pdf":
+            total += (f["page_count"] or 0) * UPLOAD_PAGE_BYTES
+            continue
+        try:
+            # Header only; photos are decoded once, at reduced size (see imaging.prepare_image)
+            with Image.open(f["path"]) as img:
+                total += min(img.width * img.height * len(img.getbands()), UPLOAD_PAGE_BYTES * 4)
+        except Exception:
+            pass
+        total += UPLOAD_PAGE_BYTES
+    return total
+
+# --- IN-FLIGHT MEMORY ---
+class MemoryBudget:
+    """Bytes reserved by requests holding rendered pages. Callers queue while the worker is full."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._changed = None  # asyncio.Condition, created on the running loop
+
+    async def acquire(self, nbytes, timeout=UPLOAD_QUEUE_SECONDS):
+        """Waits up to `timeout` seconds (None: forever) for room. Raises UploadLimitError."""
+        if nbytes > self.limit:
+            raise UploadLimitError(f"Upload needs ~{format_size(nbytes)} to process, over the worker limit")
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self.used + nbytes <= self.limit), timeout)
+            except asyncio.TimeoutError:
+                raise UploadLimitError("Server is busy processing other uploads, retry shortly", retryable=True)
+            self.used += nbytes
+            UPLOAD_RESERVED_BYTES.set(self.used)
+
+    async def release(self, nbytes):
+        async with self._changed:
+            self.used -= nbytes
+            UPLOAD_RESERVED_BYTES.set(self.used)
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes, timeout=UPLOAD_QUEUE_SECONDS):
+        await self.acquire(nbytes, timeout)
+        try:
+            yield
+        finally:
+            await self.release(nbytes)
+
+upload_memory = MemoryBudget(UPLOAD_INFLIGHT_BYTES)
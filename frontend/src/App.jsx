@@ -30,6 +30,7 @@ function App() {
   const [loadingResults, setLoadingResults] = useState(false);
   const [studentName, setStudentName] = useState("");
   const [studentFile, setStudentFile] = useState(null);
+  const [studentQuestions, setStudentQuestions] = useState(""); // e.g. "1-5, 8": only these are graded
   const [evalReport, setEvalReport] = useState("");
   
   // -- HISTORY & PAPERS LISTS --
@@ -98,11 +99,13 @@ function App() {
     formData.append('student_file', studentFile);
     formData.append('student_name', studentName);
     formData.append('reference_solution', solution); 
+    // The reference is cut down to the attempted questions before grading
+    if (studentQuestions.trim()) formData.append('questions', studentQuestions);
     try {
       const response = await axios.post('http://127.0.0.1:8000/evaluate', formData);
       setEvalReport(response.data.evaluation_report);
       fetchStudentResults();
-    } catch (err) { setError("Evaluation failed."); } 
+    } catch (err) { setError(err.response?.data?.detail || "Evaluation failed."); } 
     finally { setIsBusy(false); }
   };
 
@@ -132,7 +135,8 @@ function App() {
     setDashboardView('solution');
     setIsBusy(true);
     try {
-      const response = await axios.get(item.solution_url || item.original_url);
+      // Through the API, so an edit that is still being saved is included
+      const response = await axios.get(item.solution_url ? `http://127.0.0.1:8000/paper/${item.id}/solution` : item.original_url);
       setSolution(response.data);
       fetchStudentResults(); // Load students if any
     } catch (err) { setError("Could not load content."); } 
@@ -228,6 +232,7 @@ function App() {
                 studentResults={studentResults} loadingResults={loadingResults} fetchStudentResults={fetchStudentResults}
                 handleEvaluate={handleEvaluate} isEvaluating={isBusy} evalReport={evalReport}
                 studentName={studentName} setStudentName={setStudentName} setStudentFile={setStudentFile}
+                studentQuestions={studentQuestions} setStudentQuestions={setStudentQuestions}
                 handleDeleteStudent={(id) => deleteGeneric('student', id, setStudentResults)}
                 openVerification={setVerifyingStudent}
                 handleSaveEditedSolution={handleSaveEditedSolution}
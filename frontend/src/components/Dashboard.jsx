@@ -32,6 +32,7 @@ export default function Dashboard({
     studentResults, loadingResults, fetchStudentResults,
     handleEvaluate, isEvaluating, evalReport,
     studentName, setStudentName, setStudentFile,
+    studentQuestions, setStudentQuestions,
     handleDeleteStudent, openVerification,
     handleSaveEditedSolution
 }) {
@@ -297,8 +298,9 @@ export default function Dashboard({
                 {evalMode && (
                 <div className="bg-white p-6 rounded-lg shadow-sm border border-indigo-200 mb-6 animate-in slide-in-from-top-4">
                     <h4 className="font-bold text-lg text-gray-800 mb-4">Submit Student Work</h4>
-                    <div className="grid grid-cols-2 gap-4 mb-4">
+                    <div className="grid grid-cols-3 gap-4 mb-4">
                         <input type="text" placeholder="Student Name" className="p-2 border rounded text-sm" value={studentName} onChange={(e) => setStudentName(e.target.value)} />
+                        <input type="text" placeholder="Questions attempted (e.g. 1-5, 8)" className="p-2 border rounded text-sm" value={studentQuestions} onChange={(e) => setStudentQuestions(e.target.value)} />
                         
                         {/* CHANGED: ACCEPT PDF */}
                         <input type="file" accept="image/*,application/pdf" className="text-sm text-gray-500" onChange={(e) => setStudentFile(e.target.files[0])} />
@@ -368,7 +370,7 @@ export default function Dashboard({
                                 <td className="p-4"><button onClick={() => openVerification(student)} className="flex items-center gap-1 text-xs font-medium text-indigo-600 bg-indigo-50 px-2 py-1 rounded hover:bg-indigo-100"><Eye size={12}/> Review</button></td>
                                 <td className="p-4 flex gap-3">
                                 {student.submission_url && <a href={student.submission_url} target="_blank" className="text-gray-500 hover:text-blue-600"><FileSignature size={14}/></a>}
-                                {student.report_url && <a href={student.report_url} target="_blank" className="text-gray-500 hover:text-blue-600"><FileText size={14}/></a>}
+                                {student.report_url && <a href={`http://127.0.0.1:8000/student/${student.id}/report`} target="_blank" className="text-gray-500 hover:text-blue-600"><FileText size={14}/></a>}
                                 </td>
                                 <td className="p-4 text-right"><button onClick={() => handleDeleteStudent(student.id)} className="text-gray-400 hover:text-red-500 opacity-0 group-hover:opacity-100 transition-all p-1"><Trash2 size={16} /></button></td>
                             </tr>
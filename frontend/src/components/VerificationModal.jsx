@@ -9,7 +9,7 @@ export default function VerificationModal({ student, onClose, onSave }) {
   useEffect(() => {
     const fetchReport = async () => {
         try {
-            const response = await axios.get(student.report_url);
+            const response = await axios.get(`http://127.0.0.1:8000/student/${student.id}/report`);
             setVerifyReportText(response.data);
         } catch (e) {
             setVerifyReportText("Error loading report text.");